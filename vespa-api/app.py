@@ -1,9 +1,13 @@
-from flask import Flask, request, abort, send_from_directory, jsonify, flash, redirect
+import time
+
+from flask import Flask, request, abort, send_from_directory, jsonify, flash, redirect, g
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 
 import config
-import pdf_import
+import image_processing
+import jobs
+import metrics
 import request_processing
 import vespa_util
 
@@ -13,6 +17,20 @@ CORS(app)
 ALLOWED_EXTENSIONS = ['pdf']
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    if 'request_start' in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        metrics.request_seconds.labels(endpoint, request.method, response.status_code) \
+            .observe(time.perf_counter() - g.request_start)
+    return response
+
+
 @app.route('/')
 def hello_world():
     return 'Hello World!'
@@ -39,57 +57,72 @@ def upload_file():
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             collection = request.form['collection'] if 'collection' in request.form else ''
-            try:
-                name, pages = pdf_import.import_file(file=file, full_name=filename, collection=collection)
-                return {
-                    "document_name": name,
-                    "download_path": f'/document/{name}/download',
-                    "page_count": len(pages),
-                    "page_paths": pages
-                }
-            except pdf_import.PdfImportError as e:
-                abort(e.code, e.message)
-            return ''
+            job = request_processing.start_import_job(file, filename, collection)
+            return {
+                "job_id": job['id'],
+                "job_path": f'/jobs/{job["id"]}',
+                "document_name": job['document_name'],
+                "download_path": f'/document/{job["document_name"]}/download'
+            }, 202, {'Location': f'/jobs/{job["id"]}'}
         else:
             abort(400, 'Please provide a valid PDF file')
 
 
+@app.route('/jobs/<job_id>')
+def show_job(job_id):
+    try:
+        return jobs.load_job(job_id)
+    except FileNotFoundError:
+        abort(404, 'Job could not be found!')
+
+
 @app.route('/search', methods=['GET'])
 def search():
-    query = request.args.get('query', default='', type=str)
-    page = request.args.get('page', 0, type=int)
-    hit_count = request.args.get('hits', 5, type=int)
-    language = request.args.get('language', default='', type=str)
-    document = request.args.get('document', default=None)
-    order_by = request.args.get('order_by', default='')
-    direction = request.args.get('direction', default='desc')
-    stem_filter = request.args.get('stem_filter', default='')
-    use_synonyms = 1 if request.args.get('synonyms', 1, type=int) == 1 else 0
+    params = request_processing.search_params(request.args)
+    profile = __request_profile()
     try:
-        hits, query_metadata, bounding_boxes, total = \
-            vespa_util.query(
-                query,
-                hits=hit_count,
-                page=page,
-                language=language,
-                document=document,
-                order_by=order_by,
-                direction=direction,
-                stem_filter=stem_filter,
-                use_synonyms=use_synonyms)
+        if profile is None:
+            hits, query_metadata, total = vespa_util.query(**params)
+        else:
+            # profiled requests bypass the query cache
+            with profile:
+                hits, query_metadata, total = \
+                    profile.call(vespa_util.query, **params, trace_level=profile.trace_level, use_cache=False)
     except vespa_util.TimeoutException:
         abort(504)
+    except vespa_util.UnhealthyException:
+        abort(503)
 
-    return {
+    return __json_response({
         "hits": hits,
         "query_metadata": query_metadata,
         "total": total
-    }
+    }, profile)
+
+
+def __request_profile():
+    try:
+        return request_processing.request_profile(request.args)
+    except PermissionError as e:
+        abort(403, str(e))
+
+
+def __json_response(body, profile):
+    data, headers = request_processing.serialize_response(body, profile, app.json.dumps)
+    return app.response_class(data, mimetype='application/json', headers=headers)
 
 
 @app.route('/snippet/<snippet_id>')
 def show_snippet(snippet_id):
-    return send_from_directory(config.snippet_dir, snippet_id + config.convert_suffix)
+    try:
+        snippet_id = image_processing.resolve_snippet(snippet_id)
+    except (FileNotFoundError, ValueError):
+        abort(404)
+    # snippet ids are derived from the snippet content, hence they never change
+    response = send_from_directory(config.snippet_dir, snippet_id + config.convert_suffix, etag=snippet_id,
+                                   max_age=config.snippet_max_age)
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/status')
@@ -97,17 +130,38 @@ def status():
     return 'Up and running!'
 
 
+@app.route('/stats')
+def stats():
+    return request_processing.stats()
+
+
+@app.route('/metrics')
+def show_metrics():
+    data, content_type = metrics.export()
+    return data, 200, {'Content-Type': content_type}
+
+
 @app.route('/document/<doc_name>/page/<page_number>')
 def search_page(doc_name, page_number):
     query = request.args.get('query', default='', type=str)
+    profile = __request_profile()
     try:
-        result, query_metadata, bounding_data = vespa_util.query_doc_page(doc_name, page_number, query)
-        return {
+        if profile is None:
+            result, query_metadata, bounding_data = vespa_util.query_doc_page(doc_name, page_number, query)
+        else:
+            with profile:
+                result, query_metadata, bounding_data = \
+                    profile.call(vespa_util.query_doc_page, doc_name, page_number, query, profile.trace_level)
+        return __json_response({
                    'hit': result,
                    'query_metadata': query_metadata,
-               } | bounding_data
+               } | bounding_data, profile)
     except FileNotFoundError:
         abort(404, 'Document page could not be found!')
+    except vespa_util.TimeoutException:
+        abort(504)
+    except vespa_util.UnhealthyException:
+        abort(503)
 
 
 @app.route('/document/<doc_name>/page/<page_number>/image')
@@ -122,12 +176,32 @@ def delete_document(doc_name):
         return jsonify(result)
     except FileNotFoundError:
         abort(404, 'No pages found for document!')
+    except vespa_util.FeedException:
+        abort(507)
     except vespa_util.UnhealthyException:
         abort(503)
     except vespa_util.TimeoutException:
         abort(504)
 
 
+@app.route('/collection/<name>', methods=['DELETE'])
+def delete_collection(name):
+    return __collection_job_response(request_processing.start_collection_job('delete', name))
+
+
+@app.route('/collection/<name>/reindex', methods=['POST'])
+def reindex_collection(name):
+    return __collection_job_response(request_processing.start_collection_job('reindex', name))
+
+
+def __collection_job_response(job):
+    return {
+        "job_id": job['id'],
+        "job_path": f'/jobs/{job["id"]}',
+        "collection": job['collection']
+    }, 202, {'Location': f'/jobs/{job["id"]}'}
+
+
 @app.route('/document/<doc_name>/download')
 def download_document_file(doc_name):
     return send_from_directory(config.metadata_path, doc_name + '.pdf', as_attachment=True)
@@ -0,0 +1,286 @@
+import asyncio
+import contextlib
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from quart import Quart, request, abort, send_from_directory, jsonify, g
+from quart_cors import cors
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+
+import config
+import image_processing
+import jobs
+import metrics
+import profiling
+import request_processing
+import vespa_http
+import vespa_util
+
+# asyncio variant of app.py: vespa requests are awaited on a shared connection pool, while metadata loading and
+# image processing run on a thread pool, so that a single worker process serves many concurrent requests
+app = Quart(__name__)
+app.config['MAX_CONTENT_LENGTH'] = 20 * 1000 * 1000  # 20 MB
+app = cors(app)
+ALLOWED_EXTENSIONS = ['pdf']
+
+executor = ThreadPoolExecutor(max_workers=config.asgi_executor_workers)
+vespa_client = None
+
+
+@app.before_serving
+async def open_vespa_client():
+    global vespa_client
+    vespa_client = httpx.AsyncClient(
+        base_url=vespa_http.base_url,
+        timeout=config.asgi_vespa_timeout,
+        limits=httpx.Limits(max_connections=config.asgi_vespa_connections))
+
+
+@app.after_serving
+async def close_vespa_client():
+    await vespa_client.aclose()
+
+
+async def run_sync(function, *args):
+    # the context carries the profile of the request (see profiling.py)
+    return await asyncio.get_running_loop().run_in_executor(executor, contextvars.copy_context().run, function, *args)
+
+
+async def run_profiled(profile, function, *args):
+    """
+    run_sync, profiled by cProfile if requested
+    """
+    if profile is None:
+        return await run_sync(function, *args)
+    return await run_sync(profile.call, function, *args)
+
+
+async def vespa_query(body):
+    """
+    Send a query request body to vespa
+
+    :return: vespa response JSON
+    """
+    try:
+        vespa_http.breaker.before_request()
+    except vespa_http.CircuitOpenException:
+        metrics.vespa_errors.labels('circuit_open').inc()
+        raise
+    try:
+        with metrics.stage('vespa_query'):
+            response = await vespa_client.post('/search/', json=body)
+    except httpx.TimeoutException as e:
+        vespa_http.breaker.record_failure()
+        metrics.vespa_errors.labels('timeout').inc()
+        raise vespa_util.TimeoutException(e)
+    except httpx.TransportError as e:
+        vespa_http.breaker.record_failure()
+        metrics.vespa_errors.labels('connection').inc()
+        raise vespa_util.UnhealthyException(e)
+    except BaseException:
+        # including cancellation of the request by a disconnecting client
+        vespa_http.breaker.record_aborted()
+        raise
+    vespa_http.record_response(response.status_code)
+    if response.status_code == 504:
+        raise vespa_util.TimeoutException(response.text)
+    response.raise_for_status()
+    result = response.json()
+    profiling.record_trace(result)
+    return result
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+async def observe_request(response):
+    if 'request_start' in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        metrics.request_seconds.labels(endpoint, request.method, response.status_code) \
+            .observe(time.perf_counter() - g.request_start)
+    return response
+
+
+@app.route('/')
+async def hello_world():
+    return 'Hello World!'
+
+
+def allowed_file(filename):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+@app.route('/document', methods=['POST'])
+async def upload_file():
+    files = await request.files
+    form = await request.form
+    if 'file' not in files or files['file'].filename == '':
+        abort(400, 'Please provide a valid PDF file')
+    file = files['file']
+    if not allowed_file(file.filename):
+        abort(400, 'Please provide a valid PDF file')
+
+    filename = secure_filename(file.filename)
+    collection = form['collection'] if 'collection' in form else ''
+    # the upload is stored synchronously on the thread pool, hence it is wrapped into a werkzeug file storage
+    upload = FileStorage(file.stream, file.filename, file.name, file.content_type, file.content_length, file.headers)
+    job = await run_sync(request_processing.start_import_job, upload, filename, collection)
+    return {
+        "job_id": job['id'],
+        "job_path": f'/jobs/{job["id"]}',
+        "document_name": job['document_name'],
+        "download_path": f'/document/{job["document_name"]}/download'
+    }, 202, {'Location': f'/jobs/{job["id"]}'}
+
+
+@app.route('/jobs/<job_id>')
+async def show_job(job_id):
+    try:
+        return await run_sync(jobs.load_job, job_id)
+    except FileNotFoundError:
+        abort(404, 'Job could not be found!')
+
+
+@app.route('/search', methods=['GET'])
+async def search():
+    profile = __request_profile()
+    trace_level = profile.trace_level if profile is not None else vespa_util.traceLevel
+    body = vespa_util.query_body(**request_processing.search_params(request.args), trace_level=trace_level)
+    try:
+        with profile or contextlib.nullcontext():
+            # profiled requests bypass the query cache
+            cache_key = await run_sync(vespa_util.query_cache_key, body)
+            result = await run_sync(vespa_util.cached_query_result, cache_key) if profile is None else None
+            if result is None:
+                result = await run_profiled(profile, vespa_util.process_query_result, cache_key,
+                                            await vespa_query(body))
+    except vespa_util.TimeoutException:
+        abort(504)
+    except vespa_util.UnhealthyException:
+        abort(503)
+
+    hits, query_metadata, total = result
+    return __json_response({
+        "hits": hits,
+        "query_metadata": query_metadata,
+        "total": total
+    }, profile)
+
+
+def __request_profile():
+    try:
+        return request_processing.request_profile(request.args)
+    except PermissionError as e:
+        abort(403, str(e))
+
+
+def __json_response(body, profile):
+    data, headers = request_processing.serialize_response(body, profile, app.json.dumps)
+    return app.response_class(data, mimetype='application/json', headers=headers)
+
+
+@app.route('/snippet/<snippet_id>')
+async def show_snippet(snippet_id):
+    try:
+        snippet_id = await run_sync(image_processing.resolve_snippet, snippet_id)
+    except (FileNotFoundError, ValueError):
+        abort(404)
+    # snippet ids are derived from the snippet content, hence they never change
+    response = await send_from_directory(config.snippet_dir, snippet_id + config.convert_suffix, add_etags=False)
+    response.set_etag(snippet_id)
+    response.cache_control.public = True
+    response.cache_control.max_age = config.snippet_max_age
+    response.cache_control.immutable = True
+    return await response.make_conditional(request)
+
+
+@app.route('/status')
+async def status():
+    return 'Up and running!'
+
+
+@app.route('/stats')
+async def stats():
+    return request_processing.stats()
+
+
+@app.route('/metrics')
+async def show_metrics():
+    data, content_type = await run_sync(metrics.export)
+    return data, 200, {'Content-Type': content_type}
+
+
+@app.route('/document/<doc_name>/page/<page_number>')
+async def search_page(doc_name, page_number):
+    query = request.args.get('query', default='', type=str)
+    profile = __request_profile()
+    trace_level = profile.trace_level if profile is not None else vespa_util.traceLevel
+    body = vespa_util.doc_page_query_body(doc_name, page_number, query, trace_level)
+    try:
+        with profile or contextlib.nullcontext():
+            result, query_metadata, bounding_data = await run_profiled(
+                profile, vespa_util.process_doc_page_result, doc_name, page_number, await vespa_query(body))
+        return __json_response({
+                   'hit': result,
+                   'query_metadata': query_metadata,
+               } | bounding_data, profile)
+    except FileNotFoundError:
+        abort(404, 'Document page could not be found!')
+    except vespa_util.TimeoutException:
+        abort(504)
+    except vespa_util.UnhealthyException:
+        abort(503)
+
+
+@app.route('/document/<doc_name>/page/<page_number>/image')
+async def show_document_page_image(doc_name, page_number):
+    return await send_from_directory(config.metadata_path, doc_name + '/' + page_number + config.convert_suffix)
+
+
+@app.route('/document/<doc_name>', methods=['DELETE'])
+async def delete_document(doc_name):
+    try:
+        result = await run_sync(request_processing.delete_document, doc_name)
+        return jsonify(result)
+    except FileNotFoundError:
+        abort(404, 'No pages found for document!')
+    except vespa_util.FeedException:
+        abort(507)
+    except vespa_util.UnhealthyException:
+        abort(503)
+    except vespa_util.TimeoutException:
+        abort(504)
+
+
+@app.route('/collection/<name>', methods=['DELETE'])
+async def delete_collection(name):
+    return __collection_job_response(await run_sync(request_processing.start_collection_job, 'delete', name))
+
+
+@app.route('/collection/<name>/reindex', methods=['POST'])
+async def reindex_collection(name):
+    return __collection_job_response(await run_sync(request_processing.start_collection_job, 'reindex', name))
+
+
+def __collection_job_response(job):
+    return {
+        "job_id": job['id'],
+        "job_path": f'/jobs/{job["id"]}',
+        "collection": job['collection']
+    }, 202, {'Location': f'/jobs/{job["id"]}'}
+
+
+@app.route('/document/<doc_name>/download')
+async def download_document_file(doc_name):
+    return await send_from_directory(config.metadata_path, doc_name + '.pdf', as_attachment=True)
+
+
+if __name__ == '__main__':
+    app.run()
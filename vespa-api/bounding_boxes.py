@@ -2,38 +2,51 @@ import math
 from functools import cmp_to_key
 
 
-def flatten_bounding_boxes(bounding_boxes, max_width=math.inf, max_height=math.inf):
+def flatten_bounding_boxes(bounding_boxes, max_width=math.inf, max_height=math.inf, order=None):
     """
     Flatten dict from terms to bounding boxes into a list sorted by box positions (ltr)
 
     :param bounding_boxes: dict with shape term => [boxes]
     :param max_width: Width that should not be exceeded
     :param max_height: Height that should not be exceeded
+    :param order: reading order of the boxes precomputed during import (see reading_order), sorted at runtime if None
     """
-    flat_boxes = []
-    for word, boxes in bounding_boxes.items():
-        for box in boxes:
-            if round(box[1]) <= max_width and round(box[3]) <= max_height:
-                flat_boxes.append({
-                    'box': box,
-                    'word': word
-                })
+    flat_boxes = [{'box': box, 'word': word} for word, boxes in bounding_boxes.items() for box in boxes]
+    if order is not None and len(order) == len(flat_boxes):
+        return [flat_boxes[i] for i in order
+                if round(flat_boxes[i]['box'][1]) <= max_width and round(flat_boxes[i]['box'][3]) <= max_height]
+
+    flat_boxes = [box_item for box_item in flat_boxes
+                  if round(box_item['box'][1]) <= max_width and round(box_item['box'][3]) <= max_height]
     return sorted(flat_boxes, key=cmp_to_key(__cmp_boxes))
 
 
-def flatten_snippet_bounding_boxes(bounding_boxes, surrounding_box):
+def flatten_snippet_bounding_boxes(bounding_boxes, surrounding_box, order=None):
     """
         Flatten dict from terms to bounding boxes into a list sorted by box positions (ltr).
         Also filter out boxes not contained in surrounding box
 
         :param bounding_boxes: dict with shape term => [boxes]
         :param surrounding_box: outer bounds of snippet
+        :param order: precomputed reading order of the boxes (see reading_order)
     """
-    flat_boxes = flatten_bounding_boxes(bounding_boxes)
+    flat_boxes = flatten_bounding_boxes(bounding_boxes, order=order)
     filtered_flat_boxes = __filter_outside_boxes(flat_boxes, surrounding_box)
     return filtered_flat_boxes
 
 
+def reading_order(bounding_boxes):
+    """
+    Compute the reading order of all boxes once, so that it can be stored with the page metadata during import
+
+    :param bounding_boxes: dict with shape term => [boxes]
+    :return: indices of the boxes (enumerated in dict order, term by term) sorted by box positions (ltr)
+    """
+    flat_boxes = [{'box': box, 'index': i} for i, box in
+                  enumerate(box for boxes in bounding_boxes.values() for box in boxes)]
+    return [box_item['index'] for box_item in sorted(flat_boxes, key=cmp_to_key(__cmp_boxes))]
+
+
 def __filter_outside_boxes(bounding_boxes, surrounding_box):
     filtered_boxes = []
     for box_item in bounding_boxes:
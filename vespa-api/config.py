@@ -7,4 +7,70 @@ snippet_margin = 0.03  # percent
 snippet_highlight_color = (0, 254, 255, 128)
 
 vespa_url = "http://localhost"
-vespa_port = 8080
\ No newline at end of file
+vespa_port = 8080
+
+import_chunk_pages = 50  # documents with more pages get split up between import workers
+
+render_dpi = 200
+render_threads = 1  # poppler processes per rendered page chunk
+render_chunk_pages = 10  # pages rasterized per poppler call
+thumb_size = 1500  # minimum bounding size of page thumbnails used for snippets
+
+feed_connections = 8  # concurrent feed operations during import
+feed_max_retries = 5  # retries of feed operations rejected with 429/503
+feed_backoff = 0.5  # seconds, doubled on every retry
+feed_timeout = 30  # seconds
+visit_documents = 1000  # document ids requested per visit response when deleting documents
+
+tombstone_dir = f"{metadata_path}/.tombstones"  # removed document files awaiting deletion in the background
+
+job_dir = "/tmp/vespa-api-jobs"  # states and uploads of background jobs
+job_workers = 2  # background worker processes per API worker
+collection_job_workers = 1  # separate background worker processes per API worker for collection jobs
+job_retention = 7 * 24 * 60 * 60  # seconds
+job_timeout = 60 * 60  # seconds without progress after which a running job is considered failed (crashed worker)
+collection_job_documents = 4  # documents deleted or reindexed concurrently by a collection job
+
+manifest_path = f"{metadata_path}/import_manifest.json"  # content hashes of documents imported by pdf_import.py
+manifest_save_interval = 30  # seconds
+
+metadata_format = "binary"  # format of stored page metadata: binary | json
+metadata_suffix = ".meta"
+
+metadata_cache_bytes = 128 * 1000 * 1000  # memory budget of the page metadata cache per worker
+metadata_cache_check_interval = 2  # seconds between modification checks of cached page metadata
+metadata_mmap_bytes = 4 * 1000 * 1000  # larger binary metadata files are memory-mapped instead of read into memory
+
+snippet_workers = 8  # threads building snippets of search hits per API worker
+snippet_request_workers = 4  # snippets of a single search request built concurrently
+
+snippet_cache_bytes = 1000 * 1000 * 1000  # size budget of the snippet directory, enforced by snippet_cleanup.py
+snippet_min_age = 10 * 60  # seconds a snippet is kept at least after its last use, so that clients can load it
+
+snippet_mode = "eager"  # eager: snippets are stored during search | lazy: snippets are rendered on first request
+snippet_secret_path = f"{metadata_path}/snippet_secret"  # key signing lazy snippet urls, created if missing
+snippet_max_age = 24 * 60 * 60  # seconds clients may cache snippets
+
+page_image_cache_bytes = 256 * 1000 * 1000  # memory budget of decoded page thumbnails per worker
+snippet_min_width = 750  # pixels, page thumbnails are decoded at the lowest JPEG draft resolution at least this wide
+
+query_cache_backend = "memory"  # cache of search results: memory (per worker) | file (shared by workers) | "" (disabled)
+query_cache_ttl = 5 * 60  # seconds, keep below snippet_min_age so that cached snippets are still available
+query_cache_bytes = 64 * 1000 * 1000
+query_cache_dir = "/tmp/vespa-api-query-cache"  # file backend
+query_cache_sweep_interval = 60  # seconds between size checks of the file backend
+index_generation_path = f"{metadata_path}/index_generation"  # changed on every feed or delete to invalidate caches
+
+asgi_executor_workers = 16  # threads for metadata loading and image processing per ASGI worker (asgi_app.py)
+asgi_vespa_connections = 100  # concurrent vespa requests per ASGI worker
+asgi_vespa_timeout = 10  # seconds
+
+vespa_pool_size = 16  # keep-alive connections to vespa per process (at least feed_connections)
+vespa_timeout = 10  # seconds
+vespa_breaker_failures = 5  # consecutive failed requests opening the circuit breaker
+vespa_breaker_reset = 10  # seconds requests fail fast before vespa is tried again
+vespa_health_interval = 5  # seconds between health probes without successful requests
+
+request_profiling = False  # allow profile=1 / trace=<level> on /search and /document/<name>/page/<number>
+request_profiling_top = 30  # functions listed in the cProfile statistics of profile=1
+request_profiling_max_trace_level = 5  # upper bound of the vespa traceLevel requested by trace=<level>
@@ -1,8 +1,15 @@
 import os
 import shutil
+import threading
+import time
 import config
+import page_metadata
 from enum import IntEnum
 
+purge_event = threading.Event()
+purger_pid = None
+purger_lock = threading.Lock()
+
 
 class ResultCode(IntEnum):
     SUCCESS = 200
@@ -29,26 +36,66 @@ class FileCommandResult:
 
 def remove_document_metadata(document):
     """
-    Safely remove the metadata folder and the copied pdf created in the file system during import
+    Safely remove the metadata folder and the copied pdf created in the file system during import. The files are
+    moved into config.tombstone_dir, which is emptied by a background thread per process (see purge_tombstones).
     """
     document_name = get_file_name(document)
     path = os.path.join(config.metadata_path, document_name)
     errors = []
-
-    try:
-        shutil.rmtree(path)
-    except (shutil.Error, OSError) as e:
-        errors.append(e)
+    page_metadata.cache.invalidate(document_name)
+    os.makedirs(config.tombstone_dir, exist_ok=True)
+    tombstone = f'{document_name}.{time.time_ns()}.{os.getpid()}'
 
     pdf_path = path + '.pdf'
-    try:
-        os.remove(pdf_path)
-    except OSError as e:
-        errors.append(e)
+    for source, target in [(path, tombstone), (pdf_path, tombstone + '.pdf')]:
+        try:
+            # renaming is atomic and instant, the document can be imported again right away
+            os.rename(source, os.path.join(config.tombstone_dir, target))
+        except OSError as e:
+            errors.append(e)
 
+    if len(errors) < 2:
+        __wake_purger()
     return FileCommandResult([path, pdf_path], errors)
 
 
+def purge_tombstones():
+    """
+    Delete all files of removed documents. Leftovers of interrupted purges are deleted by the next call or the cron
+    job (see cron_container.txt).
+    """
+    try:
+        entries = list(os.scandir(config.tombstone_dir))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+    return len(entries)
+
+
+def __wake_purger():
+    # a single purger thread per process, removals while it is purging trigger another pass
+    global purger_pid
+    with purger_lock:
+        if purger_pid != os.getpid():
+            purger_pid = os.getpid()
+            threading.Thread(target=__purge_loop, name='purge-tombstones', daemon=True).start()
+    purge_event.set()
+
+
+def __purge_loop():
+    while True:
+        purge_event.wait()
+        purge_event.clear()
+        purge_tombstones()
+
+
 def get_file_name(path):
     """
     Strip path and file ending
@@ -58,3 +105,7 @@ def get_file_name(path):
         return '.'.join(full_name.rsplit('.')[:-1])
     else:
         return full_name
+
+
+if __name__ == '__main__':
+    print(f'Purged {purge_tombstones()} removed document files.')
@@ -3,4 +3,10 @@ import os
 for k,v in os.environ.items():
     if k.startswith("GUNICORN_"):
         key = k.split('_', 1)[1].lower()
-        locals()[key] = v
\ No newline at end of file
+        locals()[key] = v
+
+def child_exit(server, worker):
+    # drop the live gauges of exited workers from the aggregated /metrics
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
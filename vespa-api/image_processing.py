@@ -1,31 +1,200 @@
 from PIL import Image, ImageDraw
 import config
+import metrics
+import page_metadata
+import base64
+import hashlib
+import hmac
 import json
-from tempfile import NamedTemporaryFile
 import os
-from pathlib import Path
+import secrets
+import threading
+from collections import OrderedDict
 
 # Prevent warning for large images
 Image.MAX_IMAGE_PIXELS = 160000000
 
+snippet_secret = None
+draft_reductions = (8, 4, 2, 1)  # JPEG draft mode decodes at 1/8, 1/4, 1/2 or full resolution
+
+
+class PageImageCache:
+    """
+    LRU cache of decoded page thumbnails shared by all requests of a worker process, so that snippets of popular pages
+    are cropped without decoding the JPEG again. Thumbnails are decoded at the lowest JPEG draft resolution, which still
+    is at least as wide as the snippets need to be. Decodes of different resolutions are cached separately. Entries are
+    validated against the thumbnail version on every access.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, document_name, page, image_version=None, min_width=None):
+        """
+        :param image_version: expected version of the thumbnail (see page_image_version), checked on disk if None
+        :param min_width: minimum width of the decoded image in pixels (default config.snippet_min_width), the full
+        resolution is decoded for thumbnails narrower than that
+        :return: decoded image, its scale compared to the stored thumbnail and its version
+        """
+        min_width = config.snippet_min_width if min_width is None else min_width
+        path = page_image_path(document_name, page)
+        if image_version is None:
+            image_version = page_image_version(path)
+        with self.lock:
+            for reduction in draft_reductions:
+                entry = self.entries.get((document_name, str(page), reduction))
+                if entry is not None and entry.version == image_version \
+                        and (entry.image.width >= min_width or reduction == 1):
+                    self.entries.move_to_end((document_name, str(page), reduction))
+                    self.hits += 1
+                    metrics.cache_lookup('page_image', True)
+                    return entry.image, entry.scale, entry.version
+
+        with metrics.stage('page_image_decode'), Image.open(path) as file:
+            version = page_image_version(path)
+            width, height = file.size
+            reduction = next(reduction for reduction in draft_reductions if -(-width // reduction) >= min_width
+                             or reduction == 1)
+            if reduction > 1:
+                file.draft(file.mode, (-(-width // reduction), -(-height // reduction)))
+            image = file.copy()
+        # the actual reduction, draft mode only applies to JPEG
+        reduction = round(width / image.width)
+        key = (document_name, str(page), reduction)
+        entry = ImageCacheEntry(image, image.width / width, version, image.width * image.height * len(image.getbands()))
+        with self.lock:
+            self.misses += 1
+            for other in draft_reductions:
+                other_entry = self.entries.get((document_name, str(page), other))
+                if other == reduction or (other_entry is not None and other_entry.version != version):
+                    self.__remove((document_name, str(page), other))
+            if entry.size <= self.max_bytes:
+                self.entries[key] = entry
+                self.bytes += entry.size
+                while self.bytes > self.max_bytes:
+                    self.__remove(next(iter(self.entries)))
+            metrics.cache_bytes.labels('page_image').set(self.bytes)
+        metrics.cache_lookup('page_image', False)
+        return entry.image, entry.scale, entry.version
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def __remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+
+class ImageCacheEntry:
+    __slots__ = ['image', 'scale', 'version', 'size']
+
+    def __init__(self, image, scale, version, size):
+        self.image = image
+        self.scale = scale
+        self.version = version
+        self.size = size
+
+
+image_cache = PageImageCache(config.page_image_cache_bytes)
+
+
+def snippet_id(document_name, page, box, image_version):
+    """
+    Derive a deterministic snippet id, so that repeated queries reuse previously stored snippets
+
+    :param box: crop box of the snippet on the page image
+    :param image_version: version of the page image the snippet is cropped from (see page_image_version)
+    """
+    key = f'{document_name}|{page}|{",".join(str(round(c, 3)) for c in box)}|{image_version}|{config.convert_type}'
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def snippet_token(document_name, page, box, image_version):
+    """
+    Encode a snippet into a signed token, so that the snippet can be rendered once it is requested (lazy snippet mode)
+
+    :return: url safe token of the snippet data and its signature
+    """
+    payload = json.dumps([document_name, page, [round(c) for c in box], image_version], separators=(',', ':'))
+    payload = base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+    return f'{payload}.{__sign(payload)}'
+
+
+def resolve_snippet(snippet):
+    """
+    Resolve a snippet id or token to the id of a stored snippet, rendering the snippet of tokens if necessary
+
+    :param snippet: snippet id (eager snippet mode) or token (lazy snippet mode)
+    :return: snippet id, raises FileNotFoundError for invalid or outdated snippets
+    """
+    if '.' not in snippet:
+        return snippet
+
+    payload, signature = snippet.split('.', 1)
+    if not hmac.compare_digest(signature.encode('utf-8'), __sign(payload).encode('ascii')):
+        raise FileNotFoundError
+    document_name, page, box, image_version = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    name = snippet_id(document_name, page, box, image_version)
+    if __reuse_snippet(name):
+        return name
+
+    page_image, scale, version = image_cache.get(document_name, page)
+    if version != image_version:
+        # page was re-imported since the search
+        raise FileNotFoundError
+    store_snippet(name, crop_page_image(page_image, scale, box))
+    return name
+
+
+def crop_page_image(page_image, scale, box):
+    """
+    Crop a box given in stored thumbnail coordinates from a cached page image, which might have a reduced resolution
+    """
+    return page_image.crop([round(c * scale) for c in box])
+
 
-def store_snippets(snippets: list[Image]):
+def page_image_path(document_name, page):
+    return f'{config.metadata_path}/{document_name}/{page}_thumb{config.convert_suffix}'
+
+
+def page_image_version(path):
+    stat = os.stat(path)
+    return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+
+def snippet_path(snippet_id):
+    return os.path.join(config.snippet_dir, snippet_id + config.convert_suffix)
+
+
+def store_snippet(snippet_id, snippet: Image):
     if not os.path.isdir(config.snippet_dir):
-        os.mkdir(config.snippet_dir)
+        os.makedirs(config.snippet_dir, exist_ok=True)
 
-    snippet_names = []
-    for snippet in snippets:
-        temp_file = NamedTemporaryFile(mode="w+b", suffix=config.convert_suffix, delete=False, dir=config.snippet_dir)
-        snippet.save(temp_file, config.convert_type)
-        snippet_names.append(Path(temp_file.name).stem)
-        snippet.close()
-        temp_file.close()
-    return snippet_names
+    # write to a temporary file first, so that concurrent requests never serve partially written snippets
+    path = snippet_path(snippet_id)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with metrics.stage('snippet_encode'):
+        snippet.save(temp_path, config.convert_type)
+    snippet.close()
+    os.replace(temp_path, path)
+    metrics.snippets_written.inc()
 
 
 def build_snippets(document_name, page, query):
-    doc_dir = f'{config.metadata_path}/{document_name}'
-    metadata = __load_meta(doc_dir, page)
+    metadata = page_metadata.load(document_name, page)
     page_image = __open_page_image(document_name, page)
     snippet_boxes = []
     for term in query:
@@ -34,13 +203,23 @@ def build_snippets(document_name, page, query):
         except KeyError:
             pass
     snippet_boxes = __filter_boxes(snippet_boxes)
+    image_version = page_image_version(page_image.filename)
+    # only the image header has been read so far
+    page_image.close()
     snippet_names = []
+    cached_image = None
     for box in snippet_boxes:
-        snippet = page_image.crop(box)
-        snippet_names.extend(store_snippets([snippet]))
+        if config.snippet_mode == 'lazy':
+            snippet_names.append(snippet_token(document_name, page, box, image_version))
+            continue
+        name = snippet_id(document_name, page, box, image_version)
+        if not __reuse_snippet(name):
+            if cached_image is None:
+                cached_image = image_cache.get(document_name, page, image_version)
+            store_snippet(name, crop_page_image(cached_image[0], cached_image[1], box))
+        snippet_names.append(name)
     snippet_boxes = [__box_pil2pdf(box, metadata['dimensions']['thumbScale'], metadata['dimensions']['origHeight'])
                       for box in snippet_boxes]
-    page_image.close()
     return snippet_names, snippet_boxes, metadata
 
 
@@ -60,6 +239,39 @@ def __filter_boxes(boxes):
     return filtered_boxes
 
 
+def __sign(payload):
+    digest = hmac.new(__snippet_secret(), payload.encode('ascii'), hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+
+def __snippet_secret():
+    global snippet_secret
+    if snippet_secret is None:
+        # shared by all API workers through the file system, the key is written to a temporary file and published by
+        # a hard link, so that no worker reads a partially written key
+        temp_path = f'{config.snippet_secret_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(secrets.token_bytes(32))
+        try:
+            os.link(temp_path, config.snippet_secret_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+        with open(config.snippet_secret_path, 'rb') as file:
+            snippet_secret = file.read()
+    return snippet_secret
+
+
+def __reuse_snippet(snippet_id):
+    # refresh the modification time, which orders snippets for eviction by snippet_cleanup.py
+    try:
+        os.utime(snippet_path(snippet_id))
+        return True
+    except FileNotFoundError:
+        return False
+
+
 def __sort_boxes(b):
     return b[1]
 
@@ -97,7 +309,7 @@ def __highlight_page(document_name, page, query, metadata=None):
     doc_dir = f'{config.metadata_path}/{document_name}'
     image = Image.open(f'{doc_dir}/{page}{config.convert_suffix}').convert("RGBA")
     if not metadata:
-        metadata = __load_meta(doc_dir, page)
+        metadata = page_metadata.load(document_name, page)
     overlay = Image.new("RGBA", image.size, (255, 255, 255, 0))
     for term in query:
         __highlight_term(overlay, metadata, term)
@@ -138,12 +350,6 @@ def __add_margins(box, width, height):
     return box
 
 
-def __load_meta(doc_dir, page):
-    with open(f'{doc_dir}/{page}.json', 'r') as file:
-        metadata = json.load(file)
-        return metadata
-
-
 def main():
     snippets, _ = build_snippets('multipage_test', 1, ['adc', 'signal', 'corps'])
     [snippet.show() for snippet in snippets]
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import time
+
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdftypes import resolve1, PDFStream
+
+import config
+
+hash_size = 16  # bytes
+read_chunk_size = 1024 * 1024
+
+
+class ImportManifest:
+    """
+    Keeps track of content hashes of imported documents and their pages, so that re-running an import only processes
+    new or changed documents and pages. The manifest is stored as JSON at config.manifest_path.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or config.manifest_path
+        self.last_save = time.time()
+        try:
+            with open(self.path, 'r') as file:
+                self.documents = json.load(file)['documents']
+        except FileNotFoundError:
+            self.documents = {}
+
+    def get(self, name):
+        return self.documents.get(name)
+
+    def update(self, name, entry):
+        """
+        Store the manifest entry of a (re-)imported document and save the manifest every config.manifest_save_interval
+        seconds
+        """
+        self.documents[name] = entry
+        if time.time() - self.last_save > config.manifest_save_interval:
+            self.save()
+
+    def remove(self, name):
+        self.documents.pop(name, None)
+
+    def save(self):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'documents': self.documents}, file)
+        os.replace(temp_path, self.path)
+        self.last_save = time.time()
+
+
+def document_entry(path, collection, document_hash, page_hashes):
+    return {
+        'source': path,
+        'collection': collection,
+        'hash': document_hash,
+        'pages': page_hashes
+    }
+
+
+def file_hash(path):
+    """
+    Content hash of a whole file
+    """
+    digest = hashlib.blake2b(digest_size=hash_size)
+    with open(path, 'rb') as file:
+        while chunk := file.read(read_chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def page_hashes(path):
+    """
+    Content hashes for each page of a PDF, covering the page dimensions, content streams and embedded images/forms
+    (e.g. scans) of the page. Pages are hashed without any layout analysis or rendering.
+
+    :param path: path to the PDF
+    :return: list of hex digests in page order
+    """
+    hashes = []
+    with open(path, 'rb') as file:
+        for page in PDFPage.get_pages(file):
+            digest = hashlib.blake2b(digest_size=hash_size)
+            digest.update(repr(page.mediabox).encode())
+            for stream in page.contents:
+                digest.update(__stream_bytes(stream))
+            xobjects = resolve1(resolve1(page.resources).get('XObject', {})) if page.resources else {}
+            for name in sorted(xobjects or {}):
+                digest.update(str(name).encode())
+                digest.update(__stream_bytes(xobjects[name]))
+            hashes.append(digest.hexdigest())
+    return hashes
+
+
+def __stream_bytes(stream):
+    stream = resolve1(stream)
+    if not isinstance(stream, PDFStream):
+        return b''
+    raw_data = stream.get_rawdata()
+    return raw_data if raw_data is not None else stream.get_data()
@@ -0,0 +1,168 @@
+import contextlib
+import fcntl
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+
+
+class JobStatus:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+executors = {}  # worker pools by name (see submit_job)
+executor_lock = threading.Lock()
+
+
+def create_job(job_type, **fields):
+    """
+    Create and persist the state of a new background job
+
+    :param job_type: kind of job (e.g. 'import')
+    :param fields: additional job specific state
+    :return: job state dict
+    """
+    if not os.path.isdir(config.job_dir):
+        os.makedirs(config.job_dir, exist_ok=True)
+    remove_expired_jobs()
+
+    now = time.time()
+    job = {
+        'id': uuid.uuid4().hex,
+        'type': job_type,
+        'status': JobStatus.QUEUED,
+        'errors': [],
+        'created': now,
+        'updated': now
+    } | fields
+    __store_job(job)
+    return job
+
+
+def load_job(job_id):
+    """
+    Load the current state of a job, raises FileNotFoundError for unknown jobs. Running jobs that have not been updated
+    within config.job_timeout seconds are marked as failed, since their worker process is gone.
+    """
+    if not job_id.isalnum():
+        raise FileNotFoundError
+    job = __read_job(job_id)
+    if __is_stale(job):
+        with __job_lock(job_id):
+            job = __read_job(job_id)
+            if __is_stale(job):
+                job['status'] = JobStatus.FAILED
+                job['errors'] = job.get('errors', []) + [{'code': 500, 'message': 'Job worker stopped responding'}]
+                __store_job(job)
+    return job
+
+
+def update_job(job_id, **fields):
+    """
+    Update fields of a job state. Job states are stored in the file system, so that they can be updated from worker
+    processes and read from any API worker. Updates are serialized by a lock file per job, so that concurrent updates
+    (e.g. progress of parallel workers) are not lost.
+    """
+    if not job_id.isalnum():
+        raise FileNotFoundError
+    with __job_lock(job_id):
+        job = __read_job(job_id) | fields
+        job['updated'] = time.time()
+        __store_job(job)
+    return job
+
+
+def job_file_path(job_id, suffix):
+    """
+    Path for job specific files (e.g. uploaded documents) next to the job state
+    """
+    return os.path.join(config.job_dir, job_id + suffix)
+
+
+def remove_expired_jobs():
+    """
+    Remove job states and job files (including uploads left behind by crashed workers) that have not been modified
+    within config.job_retention seconds
+    """
+    expiry = time.time() - config.job_retention
+    for entry in os.scandir(config.job_dir):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < expiry:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def submit_job(job_id, function, *args, pool='import'):
+    """
+    Run a job function on a background worker pool. The function is called with the job id followed by args.
+    Jobs whose worker process dies are marked as failed.
+
+    :param pool: 'import' (config.job_workers processes) or 'collection' (config.collection_job_workers processes), so
+    that long-running collection jobs do not hold up uploads
+    """
+    with executor_lock:
+        if pool not in executors:
+            executors[pool] = __create_executor(pool)
+        try:
+            future = executors[pool].submit(function, job_id, *args)
+        except BrokenProcessPool:
+            executors[pool] = __create_executor(pool)
+            future = executors[pool].submit(function, job_id, *args)
+
+    def fail_on_crash(done_future):
+        error = done_future.exception()
+        if error is not None:
+            update_job(job_id, status=JobStatus.FAILED, errors=[{'code': 500, 'message': str(error)}])
+
+    future.add_done_callback(fail_on_crash)
+    return future
+
+
+def __create_executor(pool):
+    # workers are started from a fork server instead of forking the API worker, whose threads (health probe, snippet
+    # pool, ASGI executor) might hold locks at the time of the fork, which would never be released in the child
+    workers = config.collection_job_workers if pool == 'collection' else config.job_workers
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+
+
+def __job_path(job_id):
+    return job_file_path(job_id, '.json')
+
+
+def __read_job(job_id):
+    with open(__job_path(job_id), 'r') as file:
+        return json.load(file)
+
+
+def __is_stale(job):
+    return job['status'] == JobStatus.RUNNING and job['updated'] < time.time() - config.job_timeout
+
+
+@contextlib.contextmanager
+def __job_lock(job_id):
+    # the job state itself is replaced on every update, hence a separate lock file (removed with the expired job files)
+    with open(job_file_path(job_id, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def __store_job(job):
+    # write to a temporary file first, so that readers never see partially written states
+    path = __job_path(job['id'])
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(job, file)
+    os.replace(temp_path, path)
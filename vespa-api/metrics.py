@@ -0,0 +1,74 @@
+"""
+Prometheus metrics of the API and the PDF import. With PROMETHEUS_MULTIPROC_DIR set, every process (gunicorn workers,
+background job workers and pdf_import.py) writes its metrics into that directory, which GET /metrics aggregates.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, \
+    generate_latest, multiprocess
+
+import profiling
+
+stage_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# search stages: vespa_query, query_metadata, metadata_load, flatten_boxes, snippets, page_image_decode, snippet_encode,
+# response_json; import stages: pdf_extract, render, thumbnail, stemming, feed
+stage_seconds = Histogram('vespa_api_stage_seconds', 'Duration of search and import processing stages', ['stage'],
+                          buckets=stage_buckets)
+request_seconds = Histogram('vespa_api_request_seconds', 'Duration of API requests', ['endpoint', 'method', 'status'],
+                            buckets=stage_buckets)
+cache_requests = Counter('vespa_api_cache_requests_total', 'Cache lookups', ['cache', 'result'])
+cache_bytes = Gauge('vespa_api_cache_bytes', 'Memory used by the in-process caches', ['cache'],
+                    multiprocess_mode='livesum')
+vespa_errors = Counter('vespa_api_vespa_errors_total', 'Failed vespa requests', ['error'])
+vespa_circuit_open = Gauge('vespa_api_vespa_circuit_open', 'Whether the vespa circuit breaker is open',
+                           multiprocess_mode='livemax')
+snippets_written = Counter('vespa_api_snippets_written_total', 'Snippet images written to the snippet directory')
+pages_imported = Counter('vespa_api_pages_imported_total', 'Document pages stored and queued for feeding')
+
+
+@contextmanager
+def stage(name):
+    """
+    Record the duration of a processing stage, also in the profile of the current request (see profiling.py)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.labels(name).observe(seconds)
+        profiling.record_stage(name, seconds)
+
+
+def timed_iter(name, iterable):
+    """
+    Record the time spent producing each item of a lazy iterable (e.g. pages parsed by pdfminer) as a stage
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def cache_lookup(cache, hit):
+    cache_requests.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def export():
+    """
+    :return: metrics of all processes in the Prometheus text format and its content type
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
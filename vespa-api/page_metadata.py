@@ -0,0 +1,497 @@
+"""
+Compact binary format for page metadata (bounding boxes of words, stems and page dimensions).
+
+Layout (little-endian):
+    header          magic 'PGMD', format version (u16), section count (u16)
+    section table   per section: tag (4 bytes), offset (u32), length (u32)
+    sections        see tags below
+
+String tables hold a count (u32), count + 1 offsets (u32) relative to the start of the string data and the UTF-8
+encoded string data. Sorted indices hold the string ids ordered by their UTF-8 bytes, so that single entries can be
+looked up by binary search directly on the file contents (memory-mapped for large files) without parsing the whole
+file.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import bounding_boxes
+import config
+import metrics
+
+magic = b'PGMD'
+version = 1
+header_format = '<4sHH'
+section_format = '<4sII'
+
+DIMENSIONS = b'DIMS'  # scale, thumbScale, origWidth, origHeight (f64)
+WORDS = b'WORD'  # string table of words in import order
+WORD_INDEX = b'WIDX'  # sorted index of words
+BOX_RANGES = b'BOXR'  # word count + 1 cumulative box counts (u32)
+BOXES = b'BOXS'  # x0, x1, y0, y1 (f32) of all boxes ordered by word
+STEMS = b'STEM'  # string table of stems
+STEM_INDEX = b'SIDX'  # sorted index of stems
+STEM_RANGES = b'STMR'  # stem count + 1 cumulative term counts (u32)
+STEM_TERMS = b'STMT'  # string table of terms ordered by stem
+ORDER = b'ORDR'  # optional reading order of all boxes (u32 indices, see bounding_boxes.reading_order)
+
+dimension_keys = ['scale', 'thumbScale', 'origWidth', 'origHeight']
+
+
+class PageMetadata(Mapping):
+    """
+    Read-only view of a binary page metadata file, behaving like the dict stored in the JSON format
+    ('boxes', 'stems', 'dimensions'). Entries are decoded lazily from the file contents. Files larger than
+    config.metadata_mmap_bytes are memory-mapped, smaller ones are read, so that cached metadata of many pages does not
+    hold a file descriptor per page.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size > config.metadata_mmap_bytes:
+                self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buffer = file.read()
+        file_magic, file_version, section_count = struct.unpack_from(header_format, self.buffer, 0)
+        if file_magic != magic or file_version > version:
+            raise ValueError(f'Unsupported page metadata file: {path}')
+
+        self.sections = {}
+        self.lengths = {}
+        table_offset = struct.calcsize(header_format)
+        for i in range(section_count):
+            tag, offset, length = struct.unpack_from(section_format, self.buffer,
+                                                     table_offset + i * struct.calcsize(section_format))
+            self.sections[tag] = offset
+            self.lengths[tag] = length
+
+        words = StringTable(self.buffer, self.sections[WORDS])
+        self.entries = {
+            'boxes': BoxMapping(self.buffer, words, self.sections[WORD_INDEX], self.sections[BOX_RANGES],
+                                self.sections[BOXES]),
+            'stems': StemMapping(self.buffer, StringTable(self.buffer, self.sections[STEMS]),
+                                 self.sections[STEM_INDEX], self.sections[STEM_RANGES],
+                                 StringTable(self.buffer, self.sections[STEM_TERMS])),
+            'dimensions': dict(zip(dimension_keys, struct.unpack_from('<4d', self.buffer, self.sections[DIMENSIONS])))
+        }
+        if ORDER in self.sections:
+            self.entries['order'] = None  # decoded on first access
+
+    def __getitem__(self, key):
+        if key == 'order' and self.entries.get('order', ()) is None:
+            self.entries['order'] = struct.unpack_from(f'<{self.lengths[ORDER] // 4}I', self.buffer,
+                                                       self.sections[ORDER])
+        return self.entries[key]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def size(self):
+        return len(self.buffer)
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+class StringTable:
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.count = struct.unpack_from('<I', buffer, offset)[0]
+        self.offsets = offset + 4
+        self.data = self.offsets + (self.count + 1) * 4
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8')
+
+    def all(self):
+        """
+        Decode all strings at once
+        """
+        offsets = struct.unpack_from(f'<{self.count + 1}I', self.buffer, self.offsets)
+        data = self.buffer[self.data:self.data + offsets[-1]]
+        return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(self.count)]
+
+    def raw(self, i):
+        start, end = struct.unpack_from('<II', self.buffer, self.offsets + i * 4)
+        return self.buffer[self.data + start:self.data + end]
+
+    def find(self, sorted_index, key):
+        """
+        Binary search for a string in a sorted index section, returns its id or -1
+        """
+        key = key.encode('utf-8')
+        low, high = 0, self.count - 1
+        while low <= high:
+            middle = (low + high) // 2
+            i = struct.unpack_from('<I', self.buffer, sorted_index + middle * 4)[0]
+            value = self.raw(i)
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle - 1
+            else:
+                return i
+        return -1
+
+
+class BoxMapping(Mapping):
+    """
+    word => [boxes] mapping on top of the memory-mapped file
+    """
+
+    def __init__(self, buffer, words, word_index, ranges, boxes):
+        self.buffer = buffer
+        self.words = words
+        self.word_index = word_index
+        self.ranges = ranges
+        self.boxes = boxes
+
+    def __getitem__(self, word):
+        i = self.words.find(self.word_index, word)
+        if i < 0:
+            raise KeyError(word)
+        return self.__boxes(i)
+
+    def __iter__(self):
+        return iter(self.words.all())
+
+    def __len__(self):
+        return len(self.words)
+
+    def items(self):
+        words = self.words.all()
+        ranges = struct.unpack_from(f'<{len(words) + 1}I', self.buffer, self.ranges)
+        values = struct.unpack_from(f'<{ranges[-1] * 4}f', self.buffer, self.boxes)
+        boxes = [list(values[j:j + 4]) for j in range(0, len(values), 4)]
+        return ((word, boxes[ranges[i]:ranges[i + 1]]) for i, word in enumerate(words))
+
+    def copy(self):
+        return dict(self.items())
+
+    def __boxes(self, i):
+        start, end = struct.unpack_from('<II', self.buffer, self.ranges + i * 4)
+        values = struct.unpack_from(f'<{(end - start) * 4}f', self.buffer, self.boxes + start * 16)
+        return [list(values[j:j + 4]) for j in range(0, len(values), 4)]
+
+
+class StemMapping(Mapping):
+    """
+    stem => [terms] mapping on top of the memory-mapped file
+    """
+
+    def __init__(self, buffer, stems, stem_index, ranges, terms):
+        self.buffer = buffer
+        self.stems = stems
+        self.stem_index = stem_index
+        self.ranges = ranges
+        self.terms = terms
+
+    def __getitem__(self, stem):
+        i = self.stems.find(self.stem_index, stem)
+        if i < 0:
+            raise KeyError(stem)
+        return self.__terms(i)
+
+    def __iter__(self):
+        return iter(self.stems.all())
+
+    def __len__(self):
+        return len(self.stems)
+
+    def items(self):
+        stems = self.stems.all()
+        terms = self.terms.all()
+        ranges = struct.unpack_from(f'<{len(stems) + 1}I', self.buffer, self.ranges)
+        return ((stem, terms[ranges[i]:ranges[i + 1]]) for i, stem in enumerate(stems))
+
+    def copy(self):
+        return dict(self.items())
+
+    def __terms(self, i):
+        start, end = struct.unpack_from('<II', self.buffer, self.ranges + i * 4)
+        return [self.terms[j] for j in range(start, end)]
+
+
+def metadata_path(doc_dir, page):
+    return f'{doc_dir}/{page}{config.metadata_suffix}'
+
+
+def json_path(doc_dir, page):
+    return f'{doc_dir}/{page}.json'
+
+
+def exists(doc_dir, page):
+    return os.path.isfile(metadata_path(doc_dir, page)) or os.path.isfile(json_path(doc_dir, page))
+
+
+class MetadataCache:
+    """
+    LRU cache of loaded page metadata shared by all requests of a worker process. The memory budget is accounted by
+    file size (binary format) or estimated from the JSON file size. Entries are validated against the file
+    modification time at most every config.metadata_cache_check_interval seconds.
+    """
+
+    json_size_factor = 4  # rough in-memory size of parsed JSON compared to its file size
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, document_name, page):
+        key = (document_name, str(page))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry.checked < config.metadata_cache_check_interval:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.cache_lookup('metadata', True)
+                return entry.metadata
+
+        if entry is not None and self.__modified(key) == entry.modified:
+            with self.lock:
+                entry.checked = now
+                self.hits += 1
+            metrics.cache_lookup('metadata', True)
+            return entry.metadata
+
+        metadata, stat = read(document_name, page)
+        size = stat.st_size if isinstance(metadata, PageMetadata) else stat.st_size * self.json_size_factor
+        with self.lock:
+            self.misses += 1
+            self.__remove(key)
+            if size <= self.max_bytes:
+                self.entries[key] = CacheEntry(metadata, size, stat.st_mtime_ns, now)
+                self.bytes += size
+                while self.bytes > self.max_bytes:
+                    self.__remove(next(iter(self.entries)))
+            metrics.cache_bytes.labels('metadata').set(self.bytes)
+        metrics.cache_lookup('metadata', False)
+        return metadata
+
+    def invalidate(self, document_name, page=None):
+        """
+        Drop cached metadata of a single page or of all pages of a document
+        """
+        with self.lock:
+            if page is not None:
+                self.__remove((document_name, str(page)))
+            else:
+                for key in [key for key in self.entries if key[0] == document_name]:
+                    self.__remove(key)
+            metrics.cache_bytes.labels('metadata').set(self.bytes)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def __remove(self, key):
+        # evicted metadata is not closed explicitly, since it might still be in use by another request. Only files
+        # above config.metadata_mmap_bytes are memory-mapped, which bounds the open file descriptors by the budget.
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def __modified(self, key):
+        doc_dir = f'{config.metadata_path}/{key[0]}'
+        for path in [metadata_path(doc_dir, key[1]), json_path(doc_dir, key[1])]:
+            try:
+                return os.stat(path).st_mtime_ns
+            except OSError:
+                pass
+        return None
+
+
+class CacheEntry:
+    __slots__ = ['metadata', 'size', 'modified', 'checked']
+
+    def __init__(self, metadata, size, modified, checked):
+        self.metadata = metadata
+        self.size = size
+        self.modified = modified
+        self.checked = checked
+
+
+cache = MetadataCache(config.metadata_cache_bytes)
+
+
+def load(document_name, page):
+    """
+    Load the metadata of a document page through the shared metadata cache
+
+    :return: PageMetadata or dict with the keys 'boxes', 'stems' and 'dimensions'
+    """
+    return cache.get(document_name, page)
+
+
+def read(document_name, page):
+    """
+    Read the metadata of a document page from disk, preferring the binary format over JSON
+
+    :return: PageMetadata or dict with the keys 'boxes', 'stems' and 'dimensions' and the os.stat_result of the file
+    """
+    doc_dir = f'{config.metadata_path}/{document_name}'
+    path = metadata_path(doc_dir, page)
+    try:
+        metadata = PageMetadata(path)
+        return metadata, os.stat(path)
+    except FileNotFoundError:
+        with open(json_path(doc_dir, page), 'r') as file:
+            return json.load(file), os.fstat(file.fileno())
+
+
+def store(doc_dir, page, page_data):
+    """
+    Store page metadata in the format set by config.metadata_format ('binary' or 'json')
+
+    :return: path of the stored file
+    """
+    if config.metadata_format == 'json':
+        path, outdated_path = json_path(doc_dir, page), metadata_path(doc_dir, page)
+        with open(path, 'w') as file:
+            json.dump(page_data, file)
+    else:
+        path, outdated_path = metadata_path(doc_dir, page), json_path(doc_dir, page)
+        write(path, page_data)
+    cache.invalidate(os.path.basename(doc_dir), page)
+
+    try:
+        os.remove(outdated_path)
+    except OSError:
+        pass
+    return path
+
+
+def remove(doc_dir, page):
+    cache.invalidate(os.path.basename(doc_dir), page)
+    for path in [metadata_path(doc_dir, page), json_path(doc_dir, page)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def write(path, page_data):
+    """
+    Write page metadata dict ('boxes', 'stems', 'dimensions' and optionally 'order') in the binary format
+    """
+    words = list(page_data['boxes'].keys())
+    box_ranges = [0]
+    boxes = []
+    for word in words:
+        for box in page_data['boxes'][word]:
+            boxes.extend(box)
+        box_ranges.append(len(boxes) // 4)
+
+    stems = list(page_data['stems'].keys())
+    stem_ranges = [0]
+    stem_terms = []
+    for stem in stems:
+        stem_terms.extend(page_data['stems'][stem])
+        stem_ranges.append(len(stem_terms))
+
+    dimensions = page_data['dimensions']
+    sections = [
+        (DIMENSIONS, struct.pack('<4d', *[dimensions[key] for key in dimension_keys])),
+        (WORDS, __pack_strings(words)),
+        (WORD_INDEX, __pack_sorted_index(words)),
+        (BOX_RANGES, struct.pack(f'<{len(box_ranges)}I', *box_ranges)),
+        (BOXES, struct.pack(f'<{len(boxes)}f', *boxes)),
+        (STEMS, __pack_strings(stems)),
+        (STEM_INDEX, __pack_sorted_index(stems)),
+        (STEM_RANGES, struct.pack(f'<{len(stem_ranges)}I', *stem_ranges)),
+        (STEM_TERMS, __pack_strings(stem_terms))
+    ]
+    if 'order' in page_data:
+        sections.append((ORDER, struct.pack(f'<{len(page_data["order"])}I', *page_data['order'])))
+
+    offset = struct.calcsize(header_format) + len(sections) * struct.calcsize(section_format)
+    table = [struct.pack(header_format, magic, version, len(sections))]
+    for tag, data in sections:
+        table.append(struct.pack(section_format, tag, offset, len(data)))
+        offset += len(data)
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(b''.join(table))
+        for tag, data in sections:
+            file.write(data)
+    os.replace(temp_path, path)
+
+
+def __pack_strings(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = [0]
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    return struct.pack(f'<I{len(offsets)}I', len(encoded), *offsets) + b''.join(encoded)
+
+
+def __pack_sorted_index(strings):
+    order = sorted(range(len(strings)), key=lambda i: strings[i].encode('utf-8'))
+    return struct.pack(f'<{len(order)}I', *order)
+
+
+def convert(folder, remove_json=False):
+    """
+    Convert all JSON page metadata files of an existing metadata folder into the binary format
+
+    :param folder: metadata folder (e.g. config.metadata_path)
+    :param remove_json: remove JSON files after successful conversion
+    :return: number of converted files
+    """
+    converted = 0
+    for root, dirs, files in os.walk(folder):
+        # skip files of removed documents (config.tombstone_dir)
+        dirs[:] = [directory for directory in dirs if not directory.startswith('.')]
+        for file_name in files:
+            page, file_type = os.path.splitext(file_name)
+            if file_type != '.json' or not page.isdigit():
+                continue
+            with open(os.path.join(root, file_name), 'r') as file:
+                page_data = json.load(file)
+            if 'order' not in page_data:
+                page_data['order'] = bounding_boxes.reading_order(page_data['boxes'])
+            write(metadata_path(root, page), page_data)
+            if remove_json:
+                os.remove(os.path.join(root, file_name))
+            converted += 1
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert JSON page metadata into the binary page metadata format')
+    parser.add_argument('folder', type=str, nargs='?', default=config.metadata_path,
+                        help='the metadata folder to convert')
+    parser.add_argument('-r', '--remove-json', action='store_true', help='remove JSON files after conversion')
+    args = parser.parse_args()
+    print(f'Converted {convert(args.folder, args.remove_json)} page metadata files.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+from pdf2image import convert_from_path
+
+import config
+import metrics
+
+# Prevent warning for large images
+Image.MAX_IMAGE_PIXELS = 160000000
+
+
+class PageRenderer:
+    """
+    Rasterizes the pages of a PDF document in chunks of consecutive pages. Each chunk is rendered by a single poppler
+    call straight to disk, instead of starting a new process and re-parsing the whole document for every single page.
+    """
+
+    def __init__(self, path, doc_dir, page_numbers=None, skip=False):
+        """
+        :param path: path to the source PDF
+        :param doc_dir: output folder of the document
+        :param page_numbers: zero-based numbers of the pages that are going to be imported (default: all pages)
+        :param skip: do not render pages which already have an image
+        """
+        self.path = path
+        self.doc_dir = doc_dir
+        self.page_numbers = set(page_numbers) if page_numbers is not None else None
+        self.skip = skip
+        self.rendered = set()
+
+    def image_path(self, page_no):
+        return f'{self.doc_dir}/{page_no}{config.convert_suffix}'
+
+    def thumb_path(self, page_no):
+        return f'{self.doc_dir}/{page_no}_thumb{config.convert_suffix}'
+
+    def render(self, page_no, page_width, page_height):
+        """
+        Make sure the full page image and its thumbnail exist on disk, rendering the next chunk of pages if needed
+
+        :param page_no: zero-based page number
+        :param page_width: width of the PDF page
+        :param page_height: height of the PDF page
+        :return: (width, height) of the page image and (width, height) of the thumbnail
+        """
+        if page_no not in self.rendered:
+            with metrics.stage('render'):
+                self.__render_chunk(page_no)
+        self.rendered.discard(page_no)
+
+        with Image.open(self.image_path(page_no)) as image:
+            image_size = image.size
+        with metrics.stage('thumbnail'):
+            thumb_size = create_thumb(self.image_path(page_no), self.thumb_path(page_no), page_width, page_height)
+        return image_size, thumb_size
+
+    def cleanup(self):
+        """
+        Remove images of pages that were rendered as part of a chunk, but never requested (e.g. after an error)
+        """
+        for page_no in self.rendered:
+            try:
+                os.remove(self.image_path(page_no))
+            except OSError:
+                pass
+        self.rendered.clear()
+
+    def __render_chunk(self, first_page):
+        last_page = first_page
+        while last_page - first_page + 1 < config.render_chunk_pages and self.__needs_rendering(last_page + 1):
+            last_page += 1
+
+        output_folder = tempfile.mkdtemp(dir=self.doc_dir)
+        try:
+            image_paths = convert_from_path(
+                self.path,
+                dpi=config.render_dpi,
+                first_page=first_page + 1,
+                last_page=last_page + 1,
+                output_folder=output_folder,
+                fmt=config.convert_type.lower(),
+                thread_count=config.render_threads,
+                paths_only=True
+            )
+            # poppler pads page numbers in file names, hence the sorted paths follow the page order
+            for page_no, image_path in enumerate(image_paths, start=first_page):
+                os.replace(image_path, self.image_path(page_no))
+                self.rendered.add(page_no)
+        finally:
+            shutil.rmtree(output_folder, ignore_errors=True)
+
+        if first_page not in self.rendered:
+            raise ValueError(f'Page {first_page} could not be rendered')
+
+    def __needs_rendering(self, page_no):
+        if self.page_numbers is not None and page_no not in self.page_numbers:
+            return False
+        return not (self.skip and os.path.isfile(self.image_path(page_no)))
+
+
+def create_thumb(image_path, thumb_path, page_width, page_height):
+    """
+    Create a downscaled copy of a page image, if it does not exist yet
+
+    :return: (width, height) of the thumbnail
+    """
+    if os.path.isfile(thumb_path):
+        with Image.open(thumb_path) as thumb:
+            return thumb.size
+
+    with Image.open(image_path) as thumb:
+        # thumbnail() on a not yet loaded JPEG uses draft mode, so the full resolution image is never decoded
+        thumb.thumbnail((max(config.thumb_size, page_width), max(config.thumb_size, page_height)))
+        thumb.save(thumb_path, config.convert_type)
+        return thumb.size
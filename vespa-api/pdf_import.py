@@ -1,17 +1,23 @@
 from pdfminer.high_level import extract_pages
 from pdfminer.layout import LTTextBox, LTTextLine, LTChar
-from pdf2image import convert_from_path
+from pdf2image import pdfinfo_from_path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import config
+import multiprocessing
 import sys
 import argparse
 import os
 from langdetect import detect, LangDetectException
 
+import bounding_boxes
 import file_processing
+import import_manifest
+import metrics
+import page_metadata
+import page_rendering
 import stemmer
 import vespa_util
 import time
-import json
 from shutil import copyfile
 
 
@@ -20,23 +26,39 @@ warnings = []
 
 class PdfImportError(Exception):
     def __init__(self, code, message):
+        super().__init__(code, message)
         self.code = code
         self.message = message
 
     def __str__(self):
-        return self.code, self.message
+        return f'{self.code} - {self.message}'
 
     def __repr__(self):
-        return self.code, self.message
+        return f'PdfImportError({self.code!r}, {self.message!r})'
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("folder", type=str, help="the folder containing PDFs to import", default="data")
     parser.add_argument('-s', '--skip', action='store_true', help="skip already imported document pages")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="number of worker processes importing documents in parallel (default 1)")
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="only import new or changed documents and pages tracked in the import manifest")
+    parser.add_argument('-p', '--prune', action='store_true',
+                        help="remove imported documents no longer found in the folder (requires --incremental)")
+    parser.add_argument('-c', '--feed-connections', type=int, default=config.feed_connections,
+                        help=f"concurrent feed operations per worker (default {config.feed_connections})")
     args = parser.parse_args()
+    # picked up by the feeders of this process and of all import workers (see import_files_parallel)
+    config.feed_connections = args.feed_connections
     wait_for_vespa()
-    log(f'Import is set to {"skip" if args.skip else "overwrite"} already existing pages.')
+    if args.incremental:
+        log('Import is set to only process new or changed documents and pages.')
+    else:
+        log(f'Import is set to {"skip" if args.skip else "overwrite"} already existing pages.')
+    if args.workers > 1:
+        log(f'Importing with {args.workers} worker processes.')
     log(f'Searching folder \'{args.folder}\' for files to import.')
 
     files = find_files(args.folder)
@@ -47,13 +69,202 @@ def main():
     if len(files) == 0:
         return
 
-    for (path, name) in progress_bar(files, prefix="Importing", suffix="Completed", total=len(files)):
-        path_parts = path.split(os.sep)
-        collection = path_parts[1] if len(path_parts) > 2 else ''
-        try:
-            import_file(collection=collection, name=name, path=path, skip=args.skip)
-        except PdfImportError as e:
-            print(e)
+    manifest = import_manifest.ImportManifest() if args.incremental else None
+
+    if args.workers > 1:
+        import_files_parallel(files, args.workers, skip=args.skip, manifest=manifest)
+    else:
+        for (path, name) in progress_bar(files, prefix="Importing", suffix="Completed", total=len(files)):
+            try:
+                if manifest is None:
+                    import_file(collection=get_collection(path), name=name, path=path, skip=args.skip)
+                else:
+                    import_file_incremental(name, path, get_collection(path), manifest, skip=args.skip)
+            except PdfImportError as e:
+                print(f'\033[K{e}')
+
+    if manifest is not None:
+        if args.prune:
+            prune_documents(args.folder, files, manifest)
+        manifest.save()
+
+
+def get_collection(path):
+    """
+    Top level folder inside the import folder is used as collection name
+    """
+    path_parts = path.split(os.sep)
+    return path_parts[1] if len(path_parts) > 2 else ''
+
+
+def import_files_parallel(files, workers, skip=False, manifest=None):
+    """
+    Import documents on a pool of worker processes. Documents with more than config.import_chunk_pages pages are split
+    into page chunks, which are processed by separate workers. Progress is reported in the order of the file list and
+    a failing document does not stop the import of other documents.
+
+    :param files: list of (path, name) tuples as returned by find_files
+    :param workers: number of worker processes
+    :param skip: skip already imported document pages
+    :param manifest: ImportManifest for only importing new or changed documents and pages (optional)
+    :return: dict mapping names of failed documents to their PdfImportError
+    """
+    failures = {}
+    manifest_entries = {}
+    # number of unfinished tasks per document, None if the document was not prepared yet
+    remaining_tasks = [None] * len(files)
+    pending = {}
+    submitted = 0
+    finished = 0
+    reported = 0
+    max_active_documents = workers * 2
+
+    bar = progress_bar(files, prefix="Importing", suffix="Completed", total=len(files))
+    next(bar)
+
+    # workers are started from a fork server, since forking this process might copy locks held by the vespa health probe
+    # thread (see vespa_http), which would never be released in the workers
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                             initializer=__init_worker, initargs=(config.feed_connections,)) as executor:
+        while reported < len(files):
+            # bound the number of documents in progress, so that documents are not all cleaned up up front
+            while submitted < len(files) and submitted - finished < max_active_documents:
+                path, name = files[submitted]
+                if manifest is None:
+                    future = executor.submit(prepare_document, name, path, skip)
+                else:
+                    future = executor.submit(
+                        prepare_incremental_import, name, path, get_collection(path), manifest.get(name))
+                pending[future] = (submitted, True)
+                submitted += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, is_preparation = pending.pop(future)
+                path, name = files[index]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if index not in failures:
+                        failures[index] = e if isinstance(e, PdfImportError) \
+                            else PdfImportError(400, f'Failed to import file: {name} - {str(e)}')
+                    result = ([], None) if is_preparation else None
+
+                if is_preparation:
+                    page_numbers, manifest_entries[index] = result
+                    chunks = chunk_pages(page_numbers) if index not in failures else []
+                    for page_numbers in chunks:
+                        chunk_future = executor.submit(
+                            import_pages, name, path, get_collection(path), skip, page_numbers)
+                        pending[chunk_future] = (index, False)
+                    remaining_tasks[index] = len(chunks)
+                else:
+                    remaining_tasks[index] -= 1
+
+                if remaining_tasks[index] == 0:
+                    finished += 1
+                    if index not in failures and manifest_entries[index] is not None:
+                        manifest.update(name, manifest_entries[index])
+
+            while reported < len(files) and remaining_tasks[reported] == 0:
+                if reported in failures:
+                    print(f'\033[K{failures[reported]}')
+                next(bar, None)
+                reported += 1
+
+    return {files[index][1]: error for index, error in failures.items()}
+
+
+def __init_worker(feed_connections):
+    config.feed_connections = feed_connections
+
+
+def prepare_document(name, path, skip=False):
+    """
+    Set up output folder and index for (re-)importing a document
+
+    :return: zero-based numbers of all pages in the document and None as manifest entry
+    """
+    doc_dir = f'{config.metadata_path}/{name}'
+    generate_output_folder(doc_dir, None, name, path, skip)
+    cleanup_vespa(name, skip)
+    return list(range(pdfinfo_from_path(path)['Pages'])), None
+
+
+def prepare_incremental_import(name, path, collection, manifest_entry):
+    """
+    Compare a document with its manifest entry and set up output folder and index for importing its new or changed
+    pages. Artifacts and index entries of changed pages and pages no longer part of the document get removed.
+
+    :param name: document name
+    :param path: path to the source PDF
+    :param collection: name of collection this document is part of
+    :param manifest_entry: manifest entry of the previous import or None
+    :return: zero-based numbers of the pages to import and the new manifest entry of the document
+    """
+    doc_dir = f'{config.metadata_path}/{name}'
+    pdf_path = f'{config.metadata_path}/{name}.pdf'
+    document_hash = import_manifest.file_hash(path)
+    if manifest_entry and manifest_entry['hash'] == document_hash and manifest_entry['collection'] == collection \
+            and os.path.isdir(doc_dir) and os.path.isfile(pdf_path):
+        return [], manifest_entry
+
+    page_hashes = import_manifest.page_hashes(path)
+    new_entry = import_manifest.document_entry(path, collection, document_hash, page_hashes)
+    if not manifest_entry or not os.path.isdir(doc_dir):
+        # unknown state of previous imports
+        return prepare_document(name, path)[0], new_entry
+
+    previous_hashes = manifest_entry['pages'] if manifest_entry['collection'] == collection else []
+    page_numbers = [page_no for page_no, page_hash in enumerate(page_hashes)
+                    if page_no >= len(previous_hashes) or previous_hashes[page_no] != page_hash
+                    or not page_metadata.exists(doc_dir, page_no)]
+
+    copyfile(path, pdf_path)
+    for page_no in page_numbers:
+        remove_page_artifacts(doc_dir, page_no)
+    for page_no in range(len(page_hashes), len(manifest_entry['pages'])):
+        remove_page_artifacts(doc_dir, page_no)
+        vespa_util.delete_page(f'{name}_{page_no}')
+    return page_numbers, new_entry
+
+
+def import_file_incremental(name, path, collection, manifest, skip=False):
+    """
+    Import only the new or changed pages of a document and record it in the import manifest
+
+    :param skip: skip already imported document pages
+    :return: document name and list of vespa feed results for the imported pages
+    """
+    try:
+        page_numbers, manifest_entry = prepare_incremental_import(name, path, collection, manifest.get(name))
+    except Exception as e:
+        raise PdfImportError(400, f'Failed to import file: {name} - {str(e)}')
+    pages = import_pages(name, path, collection, skip, page_numbers) if page_numbers else []
+    manifest.update(name, manifest_entry)
+    return name, pages
+
+
+def prune_documents(folder, files, manifest):
+    """
+    Remove documents which were imported from a folder, but no longer exist in it
+    """
+    folder_prefix = os.path.join(folder, '')
+    found = set(name for path, name in files)
+    for name, entry in list(manifest.documents.items()):
+        if name not in found and entry['source'].startswith(folder_prefix):
+            log(f'Removing document \'{name}\' missing in \'{folder}\'.')
+            vespa_util.delete_document_pages(name)
+            file_processing.remove_document_metadata(name)
+            manifest.remove(name)
+
+
+def chunk_pages(page_numbers, chunk_size=None):
+    """
+    Split page numbers of a document into chunks of consecutive pages
+    """
+    chunk_size = chunk_size or config.import_chunk_pages
+    return [page_numbers[start:start + chunk_size] for start in range(0, len(page_numbers), chunk_size)]
 
 
 class SkipException(Exception):
@@ -66,7 +277,7 @@ def cleanup_vespa(document_name, skip):
         vespa_util.delete_document_pages(document_name)
 
 
-def import_file(file=None, full_name=None, collection='', name=None, path=None, skip=False):
+def import_file(file=None, full_name=None, collection='', name=None, path=None, skip=False, progress=None):
     if file:
         name = '.'.join(full_name.rsplit('.')[:-1])
         path = f'{config.metadata_path}/{full_name}'
@@ -74,51 +285,71 @@ def import_file(file=None, full_name=None, collection='', name=None, path=None,
     doc_dir = f'{config.metadata_path}/{name}'
     generate_output_folder(doc_dir, file, name, path, skip)
     cleanup_vespa(name, skip)
+    return name, import_pages(name, path, collection, skip, progress=progress)
+
+
+def import_pages(name, path, collection='', skip=False, page_numbers=None, progress=None):
+    """
+    Extract, store and feed the pages of a document, whose output folder has already been set up
+
+    :param name: document name
+    :param path: path to the source PDF
+    :param collection: name of collection this document is part of
+    :param skip: skip already imported document pages
+    :param page_numbers: zero-based numbers of the pages to import (default: all pages)
+    :param progress: optional callback receiving the number of processed pages after each page
+    :return: list of vespa feed results for the imported pages
+    """
+    doc_dir = f'{config.metadata_path}/{name}'
+    if page_numbers is None:
+        layouts = enumerate(metrics.timed_iter('pdf_extract', extract_pages(path)))
+    else:
+        page_numbers = sorted(page_numbers)
+        layouts = zip(page_numbers,
+                      metrics.timed_iter('pdf_extract', extract_pages(path, page_numbers=page_numbers)))
+    renderer = page_rendering.PageRenderer(path, doc_dir, page_numbers, skip)
 
     try:
-        pages = []
-        for page_no, page_layout in enumerate(extract_pages(path)):
-            try:
-                image_path = f'{doc_dir}/{page_no}{config.convert_suffix}'
-                thumb_path = f'{doc_dir}/{page_no}_thumb{config.convert_suffix}'
-                json_path = f'{doc_dir}/{page_no}.json'
-
-                image = extract_page_image(path, page_no, image_path, skip)
-                thumb = create_thumb(image, page_layout, thumb_path)
-
-                text = page_layout.groups[0].get_text() if page_layout.groups else ''
-                page_id = f'{name}_{page_no}'
-                boxes = {}
-                extract_page_word_boxes(page_layout, boxes)
-                stems = get_stems(boxes, text)
-                page_data = {
-                    'boxes': boxes,
-                    'stems': stems,
-                    'dimensions': {
-                        'scale': image.width / page_layout.width,
-                        'thumbScale': thumb.width / page_layout.width,
-                        'origWidth': page_layout.width,
-                        'origHeight': page_layout.height
+        fed_pages = []
+        with vespa_util.BulkFeeder() as feeder:
+            for page_no, page_layout in layouts:
+                try:
+                    image_path = renderer.image_path(page_no)
+
+                    if skip and os.path.isfile(image_path):
+                        raise SkipException
+                    image_size, thumb_size = renderer.render(page_no, page_layout.width, page_layout.height)
+
+                    text = page_layout.groups[0].get_text() if page_layout.groups else ''
+                    page_id = f'{name}_{page_no}'
+                    boxes = {}
+                    extract_page_word_boxes(page_layout, boxes)
+                    with metrics.stage('stemming'):
+                        stems = get_stems(boxes, text)
+                    page_data = {
+                        'boxes': boxes,
+                        'order': bounding_boxes.reading_order(boxes),
+                        'stems': stems,
+                        'dimensions': {
+                            'scale': image_size[0] / page_layout.width,
+                            'thumbScale': thumb_size[0] / page_layout.width,
+                            'origWidth': page_layout.width,
+                            'origHeight': page_layout.height
+                        }
                     }
-                }
-
-                with open(json_path, 'w') as file:
-                    json.dump(page_data, file)
-                pages.append(vespa_util.feed(page_id, name, page_no, collection, text))
-            except SkipException:
-                continue
-            except (vespa_util.FeedException, vespa_util.UnhealthyException) as e:
-                safe_remove(thumb_path)
-                safe_remove(image_path)
-                safe_remove(json_path)
-                raise e
-            except Exception as e:
-                print(f'\033[KFailed to import file: {name} | page: {page_no} - Cleaning up file artifacts!')
-                safe_remove(thumb_path)
-                safe_remove(image_path)
-                safe_remove(json_path)
-                raise PdfImportError(400, f'Failed to import file: {name} | page: {page_no} - {str(e)}')
-        return name, pages
+
+                    page_metadata.store(doc_dir, page_no, page_data)
+                    fed_pages.append((page_no, feeder.feed(page_id, name, page_no, collection, text)))
+                    metrics.pages_imported.inc()
+                    if progress:
+                        progress(len(fed_pages))
+                except SkipException:
+                    continue
+                except Exception as e:
+                    print(f'\033[KFailed to import file: {name} | page: {page_no} - Cleaning up file artifacts!')
+                    remove_page_artifacts(doc_dir, page_no)
+                    raise PdfImportError(400, f'Failed to import file: {name} | page: {page_no} - {str(e)}')
+        return collect_feed_results(name, doc_dir, fed_pages)
     except PdfImportError as e:
         raise e
     except vespa_util.FeedException as e:
@@ -130,6 +361,37 @@ def import_file(file=None, full_name=None, collection='', name=None, path=None,
     except Exception as e:
         print(f'\033[KFailed to import file: {name}')
         raise PdfImportError(400, f'Failed to import file: {name} - {str(e)}')
+    finally:
+        renderer.cleanup()
+
+
+def collect_feed_results(name, doc_dir, fed_pages):
+    """
+    Wait for the feed operations of a document and clean up file artifacts of pages that failed to be fed
+
+    :param name: document name
+    :param doc_dir: output folder of the document
+    :param fed_pages: list of (page number, feed future) tuples
+    :return: list of vespa feed results for the successfully fed pages
+    """
+    pages = []
+    error = None
+    for page_no, future in fed_pages:
+        try:
+            pages.append(future.result())
+        except (vespa_util.FeedException, vespa_util.UnhealthyException) as e:
+            print(f'\033[KFailed to feed file: {name} | page: {page_no} - Cleaning up file artifacts!')
+            remove_page_artifacts(doc_dir, page_no)
+            error = error or e
+    if error:
+        raise error
+    return pages
+
+
+def remove_page_artifacts(doc_dir, page_no):
+    safe_remove(f'{doc_dir}/{page_no}_thumb{config.convert_suffix}')
+    safe_remove(f'{doc_dir}/{page_no}{config.convert_suffix}')
+    page_metadata.remove(doc_dir, page_no)
 
 
 def get_stems(boxes, text):
@@ -141,14 +403,6 @@ def get_stems(boxes, text):
     return stems
 
 
-def create_thumb(image, page_layout, thumb_path):
-    thumb = image.copy()
-    if not os.path.isfile(thumb_path):
-        thumb.thumbnail((max(1500, page_layout.width), max(1500, page_layout.height)))
-        thumb.save(thumb_path, config.convert_type)
-    return thumb
-
-
 def generate_output_folder(doc_dir, file, name, path, skip):
     if not os.path.isdir(doc_dir):
         os.mkdir(doc_dir)
@@ -163,16 +417,6 @@ def generate_output_folder(doc_dir, file, name, path, skip):
             copyfile(path, f'{config.metadata_path}/{name}.pdf')
 
 
-def extract_page_image(path, page_no, image_path, skip):
-    if not os.path.isfile(image_path) or not skip:
-        image = convert_from_path(path, first_page=page_no + 1, last_page=page_no + 1)[0]
-        # new page or default of overwriting existing document pages
-        image.save(image_path, config.convert_type)
-    else:
-        raise SkipException
-    return image
-
-
 def safe_remove(path):
     try:
         os.remove(path)
@@ -0,0 +1,115 @@
+"""
+Opt-in profiling of single search requests (profile=1 / trace=<level>, see request_profiling in config.py). Stage
+timings recorded by metrics.stage are collected per request through a context variable, which is copied to the snippet
+thread pool, so that stages of concurrently built snippets are included (their durations add up beyond the wall time).
+"""
+
+import contextvars
+import cProfile
+import io
+import pstats
+import threading
+import time
+
+import config
+
+active_profile = contextvars.ContextVar('active_profile', default=None)
+
+
+class RequestProfile:
+    """
+    Stage timings, optional cProfile statistics and the vespa trace of a single request
+    """
+
+    def __init__(self, cprofile=False, trace_level=0):
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self.trace_level = trace_level
+        self.stages = {}
+        self.vespa_trace = None
+        self.lock = threading.Lock()
+        self.cprofile_lock = threading.Lock()
+        self.start = None
+        self.token = None
+
+    def __enter__(self):
+        # entered again to cover serialization of the response (see request_processing.serialize_response)
+        if self.start is None:
+            self.start = time.perf_counter()
+        self.token = active_profile.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        active_profile.reset(self.token)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            total, count = self.stages.get(stage, (0, 0))
+            self.stages[stage] = (total + seconds, count + 1)
+
+    def call(self, function, *args, **kwargs):
+        """
+        Call function in the current thread, profiled by cProfile if requested. Only the calling thread is profiled.
+        """
+        if self.cprofile is None:
+            return function(*args, **kwargs)
+        with self.cprofile_lock:
+            # the profiler can only be enabled in one thread at a time
+            self.cprofile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.cprofile.disable()
+
+    def server_timing(self):
+        """
+        :return: value of the Server-Timing header, durations in milliseconds up to now
+        """
+        timings = [f'{stage};dur={total * 1000:.2f}' for stage, (total, count) in self.stages.items()]
+        timings.append(f'total;dur={(time.perf_counter() - self.start) * 1000:.2f}')
+        return ', '.join(timings)
+
+    def report(self):
+        """
+        :return: JSON serializable stage timings up to now, cProfile statistics and vespa trace
+        """
+        report = {
+            'total_ms': round((time.perf_counter() - self.start) * 1000, 2),
+            'stages': {stage: {'ms': round(total * 1000, 2), 'count': count}
+                       for stage, (total, count) in self.stages.items()}
+        }
+        if self.cprofile is not None:
+            report['cprofile'] = self.__top_functions(config.request_profiling_top)
+        if self.trace_level > 0:
+            report['vespa_trace'] = self.vespa_trace
+        return report
+
+    def __top_functions(self, limit):
+        stats = pstats.Stats(self.cprofile, stream=io.StringIO())
+        stats.sort_stats(pstats.SortKey.CUMULATIVE)
+        functions = []
+        for function in stats.fcn_list[:limit]:
+            file, line, name = function
+            primitive_calls, calls, total_time, cumulative_time, callers = stats.stats[function]
+            functions.append({
+                'function': f'{file}:{line}({name})',
+                'calls': calls,
+                'total_ms': round(total_time * 1000, 2),
+                'cumulative_ms': round(cumulative_time * 1000, 2)
+            })
+        return functions
+
+
+def record_stage(stage, seconds):
+    profile = active_profile.get()
+    if profile is not None:
+        profile.record(stage, seconds)
+
+
+def record_trace(result):
+    """
+    Keep the trace of a vespa response for the profile of the current request
+    """
+    profile = active_profile.get()
+    if profile is not None and profile.trace_level > 0:
+        profile.vespa_trace = result.get('trace')
+
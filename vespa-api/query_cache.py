@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import config
+import metrics
+
+backend = None
+backend_lock = threading.Lock()
+generation = (None, '')  # (file identity, index generation) last read by index_generation
+
+
+class MemoryBackend:
+    """
+    LRU cache of serialized query results of a single worker process, bounded by config.query_cache_bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self.__remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, data):
+        with self.lock:
+            self.__remove(key)
+            if len(data) > self.max_bytes:
+                return
+            self.entries[key] = (time.time() + config.query_cache_ttl, data)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                self.__remove(next(iter(self.entries)))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'memory',
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def __remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+
+
+class FileBackend:
+    """
+    Query results stored in a directory shared by all worker processes (config.query_cache_dir). Entries expire by
+    their modification time, the directory is kept within config.query_cache_bytes by a sweep at most every
+    config.query_cache_sweep_interval seconds.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.last_sweep = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key):
+        path = self.__path(key)
+        try:
+            if os.path.getmtime(path) + config.query_cache_ttl < time.time():
+                raise FileNotFoundError
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def set(self, key, data):
+        path = self.__path(key)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+        if time.time() - self.last_sweep > config.query_cache_sweep_interval:
+            self.sweep()
+
+    def sweep(self):
+        """
+        Remove expired entries and the oldest entries exceeding the size budget
+        """
+        self.last_sweep = time.time()
+        entries = []
+        total_size = 0
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+                if stat.st_mtime + config.query_cache_ttl < self.last_sweep:
+                    os.remove(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'file',
+                'hits': self.hits,
+                'misses': self.misses,
+                'max_bytes': self.max_bytes
+            }
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+
+backends = {
+    'memory': lambda: MemoryBackend(config.query_cache_bytes),
+    'file': lambda: FileBackend(config.query_cache_dir, config.query_cache_bytes)
+}
+
+
+def key(**params):
+    """
+    Cache key of normalized query parameters combined with the current index generation
+
+    :param params: normalized query parameters (see vespa_util.query)
+    """
+    data = json.dumps([params, index_generation()], sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def load(cache_key):
+    """
+    :return: cached result or None
+    """
+    cache_backend = __get_backend()
+    if cache_backend is None:
+        return None
+    data = cache_backend.get(cache_key)
+    metrics.cache_lookup('query', data is not None)
+    return json.loads(data) if data is not None else None
+
+
+def store(cache_key, result):
+    """
+    Cache a JSON serializable query result
+    """
+    cache_backend = __get_backend()
+    if cache_backend is not None:
+        cache_backend.set(cache_key, json.dumps(result, separators=(',', ':')).encode('utf-8'))
+
+
+def stats():
+    cache_backend = __get_backend()
+    return cache_backend.stats() if cache_backend is not None else None
+
+
+def index_generation():
+    """
+    Version of the search index, changed by invalidate(). The file is only read again once it has been replaced.
+    """
+    global generation
+    try:
+        stat = os.stat(config.index_generation_path)
+    except FileNotFoundError:
+        return ''
+    identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached_identity, value = generation
+    if identity == cached_identity:
+        return value
+    try:
+        with open(config.index_generation_path, 'r') as file:
+            value = file.read()
+    except FileNotFoundError:
+        return ''
+    generation = (identity, value)
+    return value
+
+
+def invalidate():
+    """
+    Invalidate cached results of all worker processes after the search index has been changed
+    """
+    path = config.index_generation_path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(f'{time.time_ns()}-{os.getpid()}-{threading.get_ident()}')
+    os.replace(temp_path, path)
+
+
+def __get_backend():
+    global backend
+    if not config.query_cache_backend:
+        return None
+    with backend_lock:
+        if backend is None:
+            backend = backends[config.query_cache_backend]()
+        return backend
@@ -1,6 +1,88 @@
+import contextlib
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pdf2image import pdfinfo_from_path
+
+import config
 import file_processing
+import image_processing
+import import_manifest
+import jobs
+import metrics
+import page_metadata
+import pdf_import
+import profiling
+import query_cache
+import vespa_http
 import vespa_util
 
+manifest_lock = threading.Lock()
+
+
+def search_params(args):
+    """
+    Parse the request arguments of GET /search into keyword arguments of vespa_util.query
+    """
+    return {
+        'query': args.get('query', default='', type=str),
+        'page': args.get('page', 0, type=int),
+        'hits': args.get('hits', 5, type=int),
+        'language': args.get('language', default='', type=str),
+        'document': args.get('document', default=None),
+        'order_by': args.get('order_by', default=''),
+        'direction': args.get('direction', default='desc'),
+        'stem_filter': args.get('stem_filter', default=''),
+        'use_synonyms': 1 if args.get('synonyms', 1, type=int) == 1 else 0
+    }
+
+
+def request_profile(args):
+    """
+    Parse the opt-in profiling arguments of the search endpoints: profile=1 adds cProfile statistics, trace=<level>
+    requests a vespa trace, both add stage timings
+
+    :return: profiling.RequestProfile or None if not requested, raises PermissionError if request_profiling is
+    disabled in config.py
+    """
+    cprofile = args.get('profile', 0, type=int) == 1
+    trace_level = max(0, min(args.get('trace', 0, type=int), config.request_profiling_max_trace_level))
+    if not cprofile and 'trace' not in args:
+        return None
+    if not config.request_profiling:
+        raise PermissionError('Request profiling is disabled')
+    return profiling.RequestProfile(cprofile, trace_level)
+
+
+def serialize_response(body, profile, dumps):
+    """
+    Serialize a JSON response body, adding the report of a profiled request to the body. The Server-Timing header of
+    a profiled request additionally covers the serialization.
+
+    :param body: JSON serializable dict
+    :param profile: profiling.RequestProfile or None
+    :param dumps: JSON serializer of the web framework (app.json.dumps)
+    :return: serialized body and response headers
+    """
+    with profile or contextlib.nullcontext():
+        if profile is not None:
+            body = body | {'profile': profile.report()}
+        with metrics.stage('response_json'):
+            data = dumps(body)
+    headers = {'Server-Timing': profile.server_timing()} if profile is not None else {}
+    return data, headers
+
+
+def stats():
+    return {
+        'metadata_cache': page_metadata.cache.stats(),
+        'page_image_cache': image_processing.image_cache.stats(),
+        'query_cache': query_cache.stats(),
+        'vespa': vespa_http.breaker.stats()
+    }
+
 
 def delete_document(document):
     document_name = file_processing.get_file_name(document)
@@ -13,3 +95,147 @@ def delete_document(document):
         'file_result': file_delete_result.__dict__,
         'total_pages': len(vespa_delete_result)
     }
+
+
+def start_import_job(file, full_name, collection=''):
+    """
+    Store an uploaded PDF and queue its import on the background worker pool
+
+    :param file: uploaded file object
+    :param full_name: secure file name of the upload
+    :param collection: name of collection the document is part of
+    :return: job state dict
+    """
+    name = '.'.join(full_name.rsplit('.')[:-1])
+    job = jobs.create_job('import', document_name=name, collection=collection, page_count=None, pages_done=0,
+                          page_paths=[])
+    upload_path = jobs.job_file_path(job['id'], '.pdf')
+    file.save(upload_path)
+    jobs.submit_job(job['id'], run_import_job, upload_path, name, collection)
+    return job
+
+
+def run_import_job(job_id, upload_path, name, collection):
+    """
+    Import an uploaded PDF and track the progress in the job state (executed in a background worker process)
+    """
+    try:
+        jobs.update_job(job_id, status=jobs.JobStatus.RUNNING, page_count=pdfinfo_from_path(upload_path)['Pages'])
+        name, pages = pdf_import.import_file(
+            name=name,
+            path=upload_path,
+            collection=collection,
+            progress=lambda pages_done: jobs.update_job(job_id, pages_done=pages_done))
+        jobs.update_job(job_id, status=jobs.JobStatus.DONE, page_count=len(pages), pages_done=len(pages),
+                        page_paths=pages, download_path=f'/document/{name}/download')
+    except pdf_import.PdfImportError as e:
+        jobs.update_job(job_id, status=jobs.JobStatus.FAILED, errors=[{'code': e.code, 'message': str(e.message)}])
+    except vespa_util.UnhealthyException as e:
+        jobs.update_job(job_id, status=jobs.JobStatus.FAILED, errors=[{'code': 503, 'message': str(e)}])
+    except vespa_util.TimeoutException as e:
+        jobs.update_job(job_id, status=jobs.JobStatus.FAILED, errors=[{'code': 504, 'message': str(e)}])
+    except Exception as e:
+        jobs.update_job(job_id, status=jobs.JobStatus.FAILED, errors=[{'code': 400, 'message': str(e)}])
+    finally:
+        try:
+            os.remove(upload_path)
+        except OSError:
+            pass
+
+
+def start_collection_job(operation, collection):
+    """
+    Queue the deletion or reindexing of all documents of a collection on the collection worker pool, which is separate
+    from the import pool, so that uploads are not held up by long-running collection jobs
+
+    :param operation: 'delete' or 'reindex'
+    :param collection: name of the collection
+    :return: job state dict
+    """
+    job = jobs.create_job(f'collection-{operation}', collection=collection, document_count=None, documents_done=0,
+                          pages_done=0)
+    jobs.submit_job(job['id'], run_collection_job, operation, collection, pool='collection')
+    return job
+
+
+def run_collection_job(job_id, operation, collection):
+    """
+    Delete or reindex all documents of a collection, config.collection_job_documents documents at a time, and track
+    the progress in the job state (executed in a background worker process)
+    """
+    lock = threading.Lock()
+    progress = {'documents_done': 0, 'pages_done': 0}
+    errors = []
+
+    def process(document):
+        pages, error = 0, None
+        try:
+            if operation == 'delete':
+                pages = delete_document(document)['total_pages']
+            else:
+                pages = __reindex_document(job_id, document, collection)
+        except Exception as e:
+            error = __job_error(e) | {'document': document}
+        with lock:
+            progress['documents_done'] += 1
+            progress['pages_done'] += pages
+            if error:
+                errors.append(error)
+            jobs.update_job(job_id, errors=errors, **progress)
+
+    try:
+        documents = vespa_util.fetch_collection_documents(collection)
+        jobs.update_job(job_id, status=jobs.JobStatus.RUNNING, document_count=len(documents))
+        with ThreadPoolExecutor(max_workers=config.collection_job_documents) as executor:
+            list(executor.map(process, documents))
+        jobs.update_job(job_id, status=jobs.JobStatus.FAILED if errors else jobs.JobStatus.DONE)
+    except Exception as e:
+        jobs.update_job(job_id, status=jobs.JobStatus.FAILED, errors=errors + [__job_error(e)])
+
+
+def __reindex_document(job_id, document, collection):
+    # importing removes the stored PDF of the document along with its metadata, hence a copy is imported
+    copy_path = jobs.job_file_path(job_id, f'-{document}.pdf')
+    shutil.copyfile(f'{config.metadata_path}/{document}.pdf', copy_path)
+    try:
+        # the manifest entry of a batch imported document is dropped while reindexing, so that an interrupted reindex is
+        # imported completely by the next incremental batch import
+        source = __update_manifest(document)
+        name, pages = pdf_import.import_file(name=document, path=copy_path, collection=collection)
+        if source is not None:
+            __update_manifest(document, import_manifest.document_entry(
+                source, collection, import_manifest.file_hash(copy_path), import_manifest.page_hashes(copy_path)))
+        return len(pages)
+    finally:
+        os.remove(copy_path)
+
+
+def __update_manifest(document, entry=None):
+    # replace or remove (entry None) the import manifest entry of a document, returns the source of the previous entry
+    with manifest_lock:
+        if not os.path.isfile(config.manifest_path):
+            return None
+        manifest = import_manifest.ImportManifest()
+        previous = manifest.get(document)
+        if entry is not None:
+            manifest.update(document, entry)
+        elif previous is not None:
+            manifest.remove(document)
+        else:
+            return None
+        manifest.save()
+        return previous['source'] if previous is not None else None
+
+
+def __job_error(error):
+    if isinstance(error, pdf_import.PdfImportError):
+        return {'code': error.code, 'message': str(error.message)}
+    if isinstance(error, vespa_util.FeedException):
+        return {'code': 507, 'message': str(error)}
+    if isinstance(error, vespa_util.UnhealthyException):
+        return {'code': 503, 'message': str(error)}
+    if isinstance(error, vespa_util.TimeoutException):
+        return {'code': 504, 'message': str(error)}
+    if isinstance(error, FileNotFoundError):
+        return {'code': 404, 'message': str(error)}
+    return {'code': 500, 'message': str(error)}
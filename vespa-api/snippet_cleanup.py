@@ -1,16 +1,54 @@
 import os
-import glob
+import time
 import config
 
 
 def main():
+    """
+    Remove least recently used snippets until the snippet directory fits into config.snippet_cache_bytes. Snippets
+    used within the last config.snippet_min_age seconds are never removed.
+    """
     print('Starting snippet cleanup!')
-    files = glob.glob(config.snippet_dir + '/*')
-    for f in files:
-        os.remove(f)
-        print(f'File \'{f}\' was removed')
+    if not os.path.isdir(config.snippet_dir):
+        print('Finished snippet cleanup!')
+        return
+
+    now = time.time()
+    snippets = []
+    total_size = 0
+    for entry in os.scandir(config.snippet_dir):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith('.tmp'):
+            # leftover of an interrupted write
+            if now - stat.st_mtime > config.snippet_min_age:
+                __remove(entry.path)
+            continue
+        snippets.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size += stat.st_size
+
+    # snippets are touched whenever they are reused, hence the oldest modification time was used least recently
+    snippets.sort()
+    removed = 0
+    for mtime, size, path in snippets:
+        if total_size <= config.snippet_cache_bytes or now - mtime < config.snippet_min_age:
+            break
+        if __remove(path):
+            total_size -= size
+            removed += 1
+    print(f'Removed {removed} snippets, {total_size} bytes in use')
     print('Finished snippet cleanup!')
 
 
+def __remove(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
 if __name__ == "__main__":
     main()
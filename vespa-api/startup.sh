@@ -5,5 +5,14 @@
 
 crontab cron_container.txt && cron
 
-# start api in foreground
-pipenv run gunicorn --config gunicorn.conf.py wsgi:app
\ No newline at end of file
+# metric files of previous runs would be aggregated as well
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+  rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
+# start api in foreground, API_SERVER=asgi serves the asyncio variant (asgi_app.py)
+if [ "$API_SERVER" = "asgi" ]; then
+  pipenv run gunicorn --config gunicorn.conf.py --worker-class uvicorn_worker.UvicornWorker asgi_app:app
+else
+  pipenv run gunicorn --config gunicorn.conf.py wsgi:app
+fi
@@ -1,3 +1,82 @@
+WORD = 0
+STEM = 1
+MATCHES = None  # trie node key of the synonyms ending at a node
+
+
+class SynonymMatcher:
+    """
+    Token-level trie of all synonyms of a query. Finds all occurrences of the synonyms in the words of a page, either
+    literally or as a combination of words sharing the stems of the synonym parts, in a single pass over the words.
+    """
+
+    def __init__(self, synonyms):
+        """
+        :param synonyms: synonyms of the query metadata (dicts with mainTerm and terms)
+        """
+        synonym_lists = [item['terms'] + [item['mainTerm']] for item in synonyms if item['mainTerm'] != '']
+        # synonyms without parentheses, which might overlap with stems of a page
+        self.terms = [remove_parenthesis(synonym) for synonym_list in synonym_lists for synonym in synonym_list]
+        self.synonyms = process_synonyms(synonym_lists)
+        self.unique_synonyms = list(dict.fromkeys(self.synonyms))
+        self.lengths = []
+        self.parts = set()
+        self.root = {}
+        for index, synonym in enumerate(self.unique_synonyms):
+            parts = synonym.split(' ')
+            self.lengths.append(len(parts))
+            self.parts.update(parts)
+            for kind in (WORD, STEM):
+                node = self.root
+                for part in parts:
+                    node = node.setdefault((kind, part), {})
+                node.setdefault(MATCHES, []).append(index)
+
+    def locate(self, words, stems=None):
+        """
+        Find positions of words that are part of fully matched synonyms
+
+        :param words: list of page words in reading order
+        :param stems: dict of page stems mapping to words, only literal synonyms are matched if None
+        :return: dict of word positions mapping to the synonyms matched at the position
+        """
+        stems_by_word = self.__stems_by_word(stems) if stems is not None else {}
+        positions = {}
+        active_nodes = []
+        for position, word in enumerate(words):
+            tokens = [(WORD, word)] + [(STEM, stem) for stem in stems_by_word.get(word, ())]
+            next_nodes = []
+            for node in active_nodes + [self.root]:
+                for token in tokens:
+                    child = node.get(token)
+                    if child is None:
+                        continue
+                    next_nodes.append(child)
+                    for index in child.get(MATCHES, []):
+                        for match_position in range(position - self.lengths[index] + 1, position + 1):
+                            positions.setdefault(match_position, set()).add(index)
+            active_nodes = next_nodes
+        return {position: [self.unique_synonyms[index] for index in sorted(indices)]
+                for position, indices in positions.items()}
+
+    def matched_synonyms(self, words):
+        """
+        :param words: list of page words in reading order
+        :return: synonyms (split up by process_synonyms) literally contained in words
+        """
+        matched = set(synonym for synonyms in self.locate(words).values() for synonym in synonyms)
+        return [synonym for synonym in self.synonyms if synonym in matched]
+
+    def __stems_by_word(self, stems):
+        # words of the page sharing the stem of a synonym part
+        stems_by_word = {}
+        for part in self.parts:
+            try:
+                words = stems[part]
+            except KeyError:
+                continue
+            for word in words:
+                stems_by_word.setdefault(word, set()).add(part)
+        return stems_by_word
 
 
 def remove_parenthesis(text: str):
@@ -17,55 +96,6 @@ def remove_parenthesis(text: str):
         return text
 
 
-def contains_synonym(synonym: str, words: []):
-    """
-    Check if list of words contains a synonym string
-    :param synonym: str
-    :param words: []
-    :return:
-    """
-    synonym_words = synonym.split(' ')
-    try:
-        index = words.index(synonym_words[0])
-        if synonym_words == words[index: index + len(synonym_words)]:
-            # full consecutive match in words
-            return True
-        else:
-            # check rest of text for synonym match
-            return contains_synonym(synonym, words[index+1])
-
-    except (IndexError, ValueError):
-        pass
-    return False
-
-
-def locate_synonym(synonym: str, words: [], locations=None, prevIndex=0):
-    """
-    Return positions of parts of a fully matched synonym in a list of words
-
-    :param locations: recursively processed list of found synonym locations
-    :param synonym: synonym string to look for
-    :param words: list of words to search
-    """
-    if locations is None:
-        locations = set()
-
-    synonym_words = synonym.split(' ')
-    try:
-        index = words.index(synonym_words[0])
-        if synonym_words == words[index: index + len(synonym_words)]:
-            # full consecutive match in document
-            for i in range(index, index + len(synonym_words)):
-                locations.add(i + prevIndex)
-            locate_synonym(synonym, words[index + len(synonym_words):], locations, index + len(synonym_words) + prevIndex)
-        else:
-            # check rest of text for synonym match
-            locate_synonym(synonym, words[index+1], locations)
-    except (IndexError, ValueError):
-        return list(locations)
-    return list(locations)
-
-
 def process_synonyms(synonyms):
     """
     Flatten structure and remove and/or split up synonyms into chunks that can be better compared with stemmed data
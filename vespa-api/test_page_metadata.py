@@ -0,0 +1,87 @@
+import mmap
+import os
+import tempfile
+import unittest
+
+import config
+import page_metadata
+
+page_data = {
+    'boxes': {
+        'zürich': [[0.5, 10.5, 2.0, 4.0], [20.0, 30.25, 2.0, 4.0]],
+        'bank': [[1.0, 2.0, 3.0, 4.0]],
+        'a': [],
+        'Über': [[5.5, 6.5, 7.5, 8.5]]
+    },
+    'stems': {
+        'zurich': ['zürich'],
+        'bank': ['bank', 'banks'],
+        'ub': []
+    },
+    'dimensions': {'scale': 0.25, 'thumbScale': 0.125, 'origWidth': 2480.0, 'origHeight': 3508.0},
+    'order': [3, 0, 1, 2]
+}
+
+
+class PageMetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.original_mmap_bytes = config.metadata_mmap_bytes
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, '1.meta')
+        page_metadata.write(self.path, page_data)
+
+    def tearDown(self):
+        config.metadata_mmap_bytes = self.original_mmap_bytes
+        self.directory.cleanup()
+
+    def test_round_trip_memory_mapped(self):
+        config.metadata_mmap_bytes = 0
+        metadata = page_metadata.PageMetadata(self.path)
+        try:
+            self.assertIsInstance(metadata.buffer, mmap.mmap)
+            self.assert_page_data(metadata)
+        finally:
+            metadata.close()
+
+    def test_round_trip_read(self):
+        config.metadata_mmap_bytes = os.path.getsize(self.path)
+        metadata = page_metadata.PageMetadata(self.path)
+        self.assertIsInstance(metadata.buffer, bytes)
+        self.assert_page_data(metadata)
+        metadata.close()
+
+    def test_order_is_optional(self):
+        page_metadata.write(self.path, {key: value for key, value in page_data.items() if key != 'order'})
+        metadata = page_metadata.PageMetadata(self.path)
+        self.assertNotIn('order', metadata)
+        self.assertEqual(metadata['boxes'].copy(), page_data['boxes'])
+        metadata.close()
+
+    def test_unsupported_file(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'{"boxes": {}}')
+        self.assertRaises(ValueError, page_metadata.PageMetadata, self.path)
+
+    def assert_page_data(self, metadata):
+        self.assertEqual(sorted(metadata), ['boxes', 'dimensions', 'order', 'stems'])
+        self.assertEqual(metadata['dimensions'], page_data['dimensions'])
+        self.assertEqual(list(metadata['order']), page_data['order'])
+
+        boxes = metadata['boxes']
+        self.assertEqual(list(boxes), list(page_data['boxes']))
+        self.assertEqual(boxes.copy(), page_data['boxes'])
+        for word, word_boxes in page_data['boxes'].items():
+            self.assertEqual(boxes[word], word_boxes)
+        self.assertNotIn('zurich', boxes)
+        self.assertNotIn('', boxes)
+
+        stems = metadata['stems']
+        self.assertEqual(list(stems), list(page_data['stems']))
+        self.assertEqual(stems.copy(), page_data['stems'])
+        for stem, terms in page_data['stems'].items():
+            self.assertEqual(stems[stem], terms)
+        self.assertRaises(KeyError, stems.__getitem__, 'zürich')
+
+
+if __name__ == '__main__':
+    unittest.main()
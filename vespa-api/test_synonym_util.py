@@ -0,0 +1,46 @@
+import unittest
+
+import synonym_util
+
+
+class SynonymMatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.matcher = synonym_util.SynonymMatcher([
+            {'mainTerm': 'united states', 'terms': ['usa', 'united states of america (country)']},
+            {'mainTerm': 'car', 'terms': ['automobile/motorcar']},
+            {'mainTerm': '', 'terms': ['ignored']}
+        ])
+
+    def test_locate_marks_all_words_of_multi_word_synonyms(self):
+        words = ['the', 'united', 'states', 'of', 'america', 'and', 'usa']
+        self.assertEqual(self.matcher.locate(words), {
+            1: ['united states of america', 'united states'],
+            2: ['united states of america', 'united states'],
+            3: ['united states of america'],
+            4: ['united states of america'],
+            6: ['usa']
+        })
+
+    def test_locate_ignores_incomplete_synonyms(self):
+        self.assertEqual(self.matcher.locate(['united', 'kingdom', 'states']), {})
+
+    def test_locate_matches_stems_only_if_given(self):
+        words = ['automobiles', 'uniting', 'statehood']
+        stems = {'automobile': ['automobiles'], 'united': ['uniting'], 'states': ['statehood']}
+        self.assertEqual(self.matcher.locate(words), {})
+        self.assertEqual(self.matcher.locate(words, stems), {
+            0: ['automobile'],
+            1: ['united states'],
+            2: ['united states']
+        })
+
+    def test_matched_synonyms_in_order_of_the_query_metadata(self):
+        words = ['a', 'car', 'made', 'in', 'the', 'united', 'states', 'motorcar']
+        self.assertEqual(self.matcher.matched_synonyms(words), ['united states', 'motorcar', 'car'])
+
+    def test_synonyms_without_main_term_are_skipped(self):
+        self.assertEqual(self.matcher.matched_synonyms(['ignored']), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import time
+import unittest
+from unittest import mock
+
+import vespa_http
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.original_breaker = vespa_http.breaker
+        vespa_http.breaker = vespa_http.CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+
+    def tearDown(self):
+        vespa_http.breaker = self.original_breaker
+
+    def test_trial_ending_in_backpressure_reopens_circuit(self):
+        breaker = vespa_http.breaker
+        vespa_http.record_response(502)
+        vespa_http.record_response(502)
+        self.assertTrue(breaker.is_open())
+        self.assertRaises(vespa_http.CircuitOpenException, breaker.before_request)
+
+        # half-open: a single trial request, answered with backpressure
+        time.sleep(0.06)
+        breaker.before_request()
+        self.assertRaises(vespa_http.CircuitOpenException, breaker.before_request)
+        vespa_http.record_response(503)
+        self.assertTrue(breaker.is_open())
+        self.assertRaises(vespa_http.CircuitOpenException, breaker.before_request)
+
+        # the next trial is let through after another reset period and closes the circuit
+        time.sleep(0.06)
+        breaker.before_request()
+        vespa_http.record_response(200)
+        self.assertFalse(breaker.is_open())
+        breaker.before_request()
+
+    def test_backpressure_while_closed_keeps_circuit_closed(self):
+        breaker = vespa_http.breaker
+        vespa_http.record_response(429)
+        vespa_http.record_response(503)
+        self.assertFalse(breaker.is_open())
+        breaker.before_request()
+
+    def test_server_errors_open_circuit(self):
+        breaker = vespa_http.breaker
+        vespa_http.record_response(500)
+        vespa_http.record_response(504)
+        self.assertTrue(breaker.is_open())
+
+    def test_client_errors_count_as_success(self):
+        breaker = vespa_http.breaker
+        vespa_http.record_response(500)
+        vespa_http.record_response(400)
+        vespa_http.record_response(500)
+        self.assertFalse(breaker.is_open())
+
+    def test_trial_ending_in_unexpected_exception_is_released(self):
+        breaker = vespa_http.breaker
+        vespa_http.record_response(500)
+        vespa_http.record_response(500)
+        time.sleep(0.06)
+        session = mock.Mock()
+        session.request.side_effect = ValueError('unexpected')
+        with mock.patch.dict(vespa_http.__dict__, {'__start_probe': lambda: None, '__get_session': lambda: session}):
+            self.assertRaises(ValueError, vespa_http.request, 'GET', '/search/')
+        # still open, but the next trial is let through
+        self.assertTrue(breaker.is_open())
+        breaker.before_request()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+import metrics
+
+base_url = f'{config.vespa_url}:{config.vespa_port}'
+backpressure_status_codes = [429, 503]  # vespa is up but overloaded, neither success nor failure, any other 5xx fails
+
+session = None
+session_pid = None
+session_lock = threading.Lock()
+probe_pid = None
+
+
+class TimeoutException(Exception):
+    pass
+
+
+class UnhealthyException(Exception):
+    pass
+
+
+class CircuitOpenException(UnhealthyException):
+    """
+    Raised without contacting vespa while the circuit breaker is open
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of vespa from the outcome of real requests and background probes. After
+    config.vespa_breaker_failures consecutive failures the circuit opens and requests fail fast for
+    config.vespa_breaker_reset seconds. Afterwards a single trial request is let through, which closes the circuit on
+    success or opens it again on failure.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial_running = False
+        self.last_success = 0
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        """
+        Raises CircuitOpenException while vespa is considered down
+        """
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.monotonic() - self.opened < self.reset_timeout or self.trial_running:
+                raise CircuitOpenException('vespa is unavailable')
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial_running = False
+            self.last_success = time.monotonic()
+        metrics.vespa_circuit_open.set(0)
+
+    def record_backpressure(self):
+        """
+        Vespa is up but overloaded. A trial request ending in backpressure keeps the circuit open for another reset
+        period, instead of blocking further trials.
+        """
+        with self.lock:
+            if self.trial_running:
+                self.trial_running = False
+                self.opened = time.monotonic()
+
+    def record_aborted(self):
+        """
+        The request ended without an outcome (e.g. an unexpected exception or a cancelled request). A trial request is
+        released, so that the next request can try again.
+        """
+        with self.lock:
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.failure_threshold or self.opened is not None:
+                self.opened = time.monotonic()
+                metrics.vespa_circuit_open.set(1)
+
+    def is_open(self):
+        with self.lock:
+            return self.opened is not None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'open': self.opened is not None,
+                'failures': self.failures,
+                'seconds_since_success': round(time.monotonic() - self.last_success, 3) if self.last_success else None
+            }
+
+
+breaker = CircuitBreaker(config.vespa_breaker_failures, config.vespa_breaker_reset)
+
+
+def request(method, path, timeout=None, **kwargs):
+    """
+    Send a request to vespa through the pooled session of the process, tracking its outcome in the circuit breaker
+
+    :param method: HTTP method
+    :param path: path on the vespa container (e.g. /search/)
+    :param timeout: seconds, config.vespa_timeout if None
+    :param kwargs: further arguments of requests.Session.request (e.g. json)
+    :return: requests.Response, raises TimeoutException, UnhealthyException or CircuitOpenException
+    """
+    __start_probe()
+    try:
+        breaker.before_request()
+    except CircuitOpenException:
+        metrics.vespa_errors.labels('circuit_open').inc()
+        raise
+    try:
+        response = __get_session().request(method, base_url + path, timeout=timeout or config.vespa_timeout,
+                                           **kwargs)
+    except requests.Timeout as e:
+        breaker.record_failure()
+        metrics.vespa_errors.labels('timeout').inc()
+        raise TimeoutException(e)
+    except requests.RequestException as e:
+        breaker.record_failure()
+        metrics.vespa_errors.labels('connection').inc()
+        raise UnhealthyException(e)
+    except BaseException:
+        breaker.record_aborted()
+        raise
+    record_response(response.status_code)
+    return response
+
+
+def record_response(status_code):
+    """
+    Track the outcome of a vespa response in the circuit breaker
+    """
+    if status_code >= 500:
+        metrics.vespa_errors.labels(str(status_code)).inc()
+    if status_code in backpressure_status_codes:
+        breaker.record_backpressure()
+    elif status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
+def healthy():
+    """
+    Health of vespa, derived from recent responses. Vespa is only probed if there has not been any successful request
+    within config.vespa_health_interval seconds.
+    """
+    __start_probe()
+    if breaker.is_open():
+        return False
+    if time.monotonic() - breaker.last_success < config.vespa_health_interval:
+        return True
+    return probe()
+
+
+def probe():
+    """
+    Check the application status of vespa, bypassing an open circuit breaker
+    """
+    try:
+        response = __get_session().get(base_url + '/ApplicationStatus', timeout=config.vespa_timeout)
+    except requests.RequestException:
+        breaker.record_failure()
+        return False
+    if response.status_code != 200:
+        breaker.record_failure()
+        return False
+    breaker.record_success()
+    return True
+
+
+def __get_session():
+    # created lazily per process, so that forked workers never share connections
+    global session, session_pid
+    with session_lock:
+        if session is None or session_pid != os.getpid():
+            session = requests.Session()
+            pool_size = max(config.vespa_pool_size, config.feed_connections)
+            session.mount(base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+            session_pid = os.getpid()
+        return session
+
+
+def __start_probe():
+    # background probe per process, keeps the health state current (and closes the circuit once vespa is back)
+    global probe_pid
+    with session_lock:
+        if probe_pid == os.getpid():
+            return
+        probe_pid = os.getpid()
+    threading.Thread(target=__probe_loop, name='vespa-health-probe', daemon=True).start()
+
+
+def __probe_loop():
+    while True:
+        time.sleep(config.vespa_health_interval)
+        if breaker.is_open() or time.monotonic() - breaker.last_success >= config.vespa_health_interval:
+            probe()
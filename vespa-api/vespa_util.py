@@ -1,43 +1,48 @@
+import contextvars
+import threading
+import time
 import traceback
-from vespa.application import Vespa
+from concurrent.futures import ThreadPoolExecutor
+from vespa.io import VespaResponse
 import json
 from langdetect import detect, LangDetectException
 import languagecodes
 import bounding_boxes
 import image_processing
+import metrics
+import page_metadata
+import profiling
+import query_cache
 import stemmer
 import config
-import requests
+import vespa_http
+from vespa_http import TimeoutException, UnhealthyException
 import synonym_util
-import itertools
 
 url = config.vespa_url
 schema = "baseline"
 port = config.vespa_port
-app = Vespa(url, port)
 searchChain = "multilangchain"
 traceLevel = 0
 timeout = "5s"
 renderer = "query-meta-json"
 max_hits = 400
 
-order_fields = ['alpha']
-order_directions = ['desc', 'asc']
+retry_status_codes = [429, 503]
 
+snippet_executor = None
+snippet_executor_lock = threading.Lock()
 
-class TimeoutException(Exception):
-    pass
+order_fields = ['alpha']
+order_directions = ['desc', 'asc']
 
 
 class FeedException(Exception):
     pass
 
 
-class UnhealthyException(Exception):
-    pass
-
-
-def query(query, hits=5, page=0, language='', document=None, order_by='', direction='desc', stem_filter='', use_synonyms=1):
+def query(query, hits=5, page=0, language='', document=None, order_by='', direction='desc', stem_filter='', use_synonyms=1,
+          trace_level=traceLevel, use_cache=True):
     """
     Launch a query at the vespa search index
 
@@ -50,7 +55,42 @@ def query(query, hits=5, page=0, language='', document=None, order_by='', direct
     :param direction: sort direction: asc | desc (default)
     :param stem_filter: JSON string of data structure describing language specific stems to be filtered
     :param use_synonyms: toggles the use of synonyms for retrieval
-    :return: result page of vespa hits enhanced with runtime-generated snippets of the original image
+    :param trace_level: vespa traceLevel of the query
+    :param use_cache: whether a cached result may be returned
+    :return: result page of vespa hits enhanced with runtime-generated snippets of the original image, query metadata
+             and total number of hits
+    """
+    body = query_body(query, hits, page, language, document, order_by, direction, stem_filter, use_synonyms,
+                      trace_level)
+    cache_key = query_cache_key(body)
+    cached = cached_query_result(cache_key) if use_cache else None
+    if cached is not None:
+        return cached
+
+    return process_query_result(cache_key, search(body))
+
+
+def search(body):
+    """
+    Send a query request body to vespa
+
+    :return: vespa response JSON, raises TimeoutException if vespa timed out
+    """
+    with metrics.stage('vespa_query'):
+        response = vespa_http.request('post', '/search/', json=body)
+    if response.status_code == 504:
+        print(response.status_code, response.text, end="\n")
+        raise TimeoutException(response.text)
+    response.raise_for_status()
+    result = response.json()
+    profiling.record_trace(result)
+    return result
+
+
+def query_body(query, hits=5, page=0, language='', document=None, order_by='', direction='desc', stem_filter='',
+               use_synonyms=1, trace_level=traceLevel):
+    """
+    Build the vespa request body of a search query (see query for the parameters)
     """
     phrases = __build_query_phrases(query)
 
@@ -75,34 +115,70 @@ def query(query, hits=5, page=0, language='', document=None, order_by='', direct
 
     yql = f'select * from sources * where {phrases} {language_and} {document_and} {order_clause};'
 
-    try:
-        result = app.query(body={
-            "traceLevel": traceLevel,
-            "searchChain": searchChain,
-            "hits": hits,
-            "offset": page * hits,
-            "timeout": timeout,
-            "yql": yql,
-            "presentation.format": renderer,
-            "stemFilter": stem_filter,  # custom non-vespa searchChain-specific param
-            "useSynonyms": use_synonyms # custom non-vespa searchChain-specific param
-        })
-    except requests.exceptions.RetryError as e:
-        print(''.join(traceback.format_exception(None, e, e.__traceback__)))
-        raise TimeoutException(e)
+    return {
+        "traceLevel": trace_level,
+        "searchChain": searchChain,
+        "hits": hits,
+        "offset": page * hits,
+        "timeout": timeout,
+        "yql": yql,
+        "presentation.format": renderer,
+        "stemFilter": stem_filter,  # custom non-vespa searchChain-specific param
+        "useSynonyms": use_synonyms # custom non-vespa searchChain-specific param
+    }
+
 
-    __extend_query_metadata(result)
+def cached_query_result(cache_key):
+    """
+    :param cache_key: cache key of the search query (see query_cache_key)
+    :return: cached result of the search query in the shape of query or None
+    """
+    cached = query_cache.load(cache_key)
+    if cached is None:
+        return None
+    return tuple(cached)
+
+
+def process_query_result(cache_key, result):
+    """
+    Enhance the vespa response of a search query with query metadata and snippets, and cache the result
+
+    :param cache_key: cache key of the search query, computed before vespa was queried (see query_cache_key)
+    :param result: vespa response JSON
+    :return: result in the shape of query
+    """
+    with metrics.stage('query_metadata'):
+        __extend_query_metadata(result)
     try:
-        __build_query_snippets(result)
-        return result.hits, result.json['root']['query-metadata'], \
-               __get_bounding_box_data(result.hits), result.number_documents_retrieved
+        hits = result.get('root', {}).get('children', [])
+        total = result.get('root', {}).get('fields', {}).get('totalCount', 0)
+        with metrics.stage('snippets'):
+            __build_query_snippets(hits, result['root']['query-metadata'])
+        query_cache.store(cache_key, [hits, result['root']['query-metadata'], total])
+        return hits, result['root']['query-metadata'], total
     except KeyError as e:
         print(''.join(traceback.format_exception(None, e, e.__traceback__)))
         raise TimeoutException(e)
 
 
+def query_cache_key(body):
+    """
+    Cache key of a search query for the current index generation. It has to be computed before vespa is queried, so
+    that a result of an index changed meanwhile is stored under the outdated generation.
+
+    :param body: vespa request body of the search query (see query_body)
+    """
+    # the request body holds the normalized query parameters, apart from the stem filter JSON
+    body = body.copy()
+    try:
+        body['stemFilter'] = json.loads(body['stemFilter']) if body['stemFilter'] else ''
+    except json.JSONDecodeError:
+        pass
+    return query_cache.key(body=body, snippet_mode=config.snippet_mode)
+
+
 def __extend_query_metadata(result):
-    query_metadata = result.json['root']['query-metadata']
+    query_metadata = result['root']['query-metadata']
     for i, phrase_translations in enumerate(query_metadata['translations']):
         multilang_terms = __collect_multilang_query_terms(phrase_translations)
         multilang_stems = __collect_multilang_query_stems(phrase_translations)
@@ -127,46 +203,51 @@ def __build_query_phrases(query):
     return phrases
 
 
-def __get_bounding_box_data(hits):
-    bounding_boxes = {}
-    for hit in hits:
-        doc = hit['fields']['parent_doc']
-        page = hit['fields']['page']
-        box_data = __load_meta(doc, page)
-        try:
-            bounding_boxes[doc][page] = box_data
-        except KeyError:
-            bounding_boxes[doc] = {}
-            bounding_boxes[doc][page] = box_data
-    return bounding_boxes
-
-
-def query_doc_page(doc, page, query):
+def query_doc_page(doc, page, query, trace_level=traceLevel):
     """
         Launch a query on a specific document page from the vespa search index
 
         :param doc: document name/id
         :param page: page number inside document
         :param query: JSON string query list or single query string (mandatory)
+        :param trace_level: vespa traceLevel of the query
         :return: relevant vespa hit + query metadata + annotated bounding box information
     """
+    body = doc_page_query_body(doc, page, query, trace_level)
+    meta = __load_meta(doc, page)
+    return process_doc_page_result(doc, page, search(body), meta)
+
+
+def doc_page_query_body(doc, page, query, trace_level=traceLevel):
+    """
+    Build the vespa request body of a query on a specific document page (see query_doc_page for the parameters)
+    """
     phrases = __build_query_phrases(query)
+    yql = f'select * from sources * where {phrases} and parent_doc matches \"{doc}\" and page matches \"{page}\";'
+    return {
+        "traceLevel": trace_level,
+        "searchChain": searchChain,
+        "timeout": timeout,
+        "yql": yql,
+        "presentation.format": renderer
+    }
 
-    try:
-        meta = __load_meta(doc, page)
-        yql = f'select * from sources * where {phrases} and parent_doc matches \"{doc}\" and page matches \"{page}\";'
 
-        result = app.query(body={
-            "traceLevel": traceLevel,
-            "searchChain": searchChain,
-            "timeout": timeout,
-            "yql": yql,
-            "presentation.format": renderer
-        })
+def process_doc_page_result(doc, page, result, meta=None):
+    """
+    Annotate the vespa response of a document page query with the bounding boxes of relevant terms
 
-        __extend_query_metadata(result)
-        hit = result.hits[0]
-        translations = result.json['root']['query-metadata']
+    :param result: vespa response JSON
+    :param meta: page metadata, loaded if None
+    :return: result in the shape of query_doc_page
+    """
+    try:
+        if meta is None:
+            meta = __load_meta(doc, page)
+        with metrics.stage('query_metadata'):
+            __extend_query_metadata(result)
+        hit = result.get('root', {}).get('children', [])[0]
+        translations = result['root']['query-metadata']
         stems = {}
         synonyms = []
         box_data = {}
@@ -181,7 +262,7 @@ def query_doc_page(doc, page, query):
         relevant_stem_terms = list(__get_relevant_terms(hit_stems, meta['stems']).keys())
         box_data = {
             'bounding_data': {
-                'boxes': __mark_relevant_boxes(relevant_stem_terms, synonyms, meta),
+                'boxes': __mark_relevant_boxes(relevant_stem_terms, synonym_util.SynonymMatcher(synonyms), meta),
                 'height': meta['dimensions']['origHeight'],
                 'width': meta['dimensions']['origWidth'],
                 'image_path': f'/document/{doc}/page/{page}/image',
@@ -190,14 +271,12 @@ def query_doc_page(doc, page, query):
             'download_path': f'/document/{doc}/download',
         }
 
-        return result.hits[0], result.json['root']['query-metadata'], box_data
+        return hit, result['root']['query-metadata'], box_data
     except (FileNotFoundError, IndexError):
         raise FileNotFoundError
 
 
-def __build_query_snippets(result):
-    hits = result.hits
-    translations = result.json['root']['query-metadata']
+def __build_query_snippets(hits, translations):
     stems = {}
     synonyms = []
     for translation in translations['translations']:
@@ -205,26 +284,57 @@ def __build_query_snippets(result):
         synonyms = synonyms + translation['synonyms']
 
     languages = set([language for stem, value in stems.items() for language in value['languages']])
-    for hit in hits:
+    synonym_matcher = synonym_util.SynonymMatcher(synonyms)
+
+    def build_snippets(hit):
         hit_lang = hit['fields']['language']
         hit_stems = [stem for stem, value in stems.items()
                      if stem != '' and (hit_lang not in languages or hit_lang in value['languages'])]
-        hit['snippets'] = __build_hit_snippets(hit, hit_stems, synonyms)
+        return __build_hit_snippets(hit, hit_stems, synonym_matcher)
+
+    # decoding, cropping and encoding of page images releases the GIL, so hits are processed concurrently
+    for hit, snippets in zip(hits, __map_concurrently(build_snippets, hits, config.snippet_request_workers)):
+        hit['snippets'] = snippets
+
 
+def __map_concurrently(function, items, limit):
+    """
+    Apply function to all items on the shared snippet thread pool with at most limit calls in flight
 
-def __build_hit_snippets(hit, stems, synonyms):
+    :return: list of results in the order of items, raises the first exception of a call
+    """
+    if limit <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    global snippet_executor
+    with snippet_executor_lock:
+        if snippet_executor is None:
+            snippet_executor = ThreadPoolExecutor(max_workers=config.snippet_workers)
+
+    slots = threading.BoundedSemaphore(limit)
+    futures = []
+    for item in items:
+        slots.acquire()
+        # the context carries the profile of the request (see profiling.py)
+        future = snippet_executor.submit(contextvars.copy_context().run, function, item)
+        future.add_done_callback(lambda _: slots.release())
+        futures.append(future)
+    return [future.result() for future in futures]
+
+
+def __build_hit_snippets(hit, stems, synonym_matcher):
     """
     Build query snippets of a specific document page containing search query items or any matching synonyms
 
     :param hit: vespa hit data of the document page
     :param stems: stemmed query terms
-    :param synonyms: data structure with synonyms matching the query
+    :param synonym_matcher: synonym_util.SynonymMatcher of the synonyms matching the query
     :return: dict containing file paths to snippet images and bounding box data
     """
     doc = hit['fields']['parent_doc']
     page = hit['fields']['page']
     relevant_stem_terms = __get_relevant_stem_terms(doc, page, stems)
-    relevant_synonym_terms = __get_relevant_synonym_terms(doc, page, synonyms)
+    relevant_synonym_terms = __get_relevant_synonym_terms(doc, page, synonym_matcher)
     relevant_terms = relevant_stem_terms + relevant_synonym_terms
     hit_snippets_names, hit_snippets_boxes, box_data = image_processing.build_snippets(doc, page, relevant_terms)
     snippet_data = [
@@ -238,23 +348,24 @@ def __build_hit_snippets(hit, stems, synonyms):
     ]
 
     for snippet in snippet_data:
-        snippet['boxes'] = __mark_relevant_boxes(relevant_stem_terms, synonyms, box_data, snippet['bounds'])
+        snippet['boxes'] = __mark_relevant_boxes(relevant_stem_terms, synonym_matcher, box_data, snippet['bounds'])
         del snippet['bounds']
 
     return snippet_data
 
 
-def __mark_relevant_boxes(terms, synonyms, box_data, surrounding_box=None):
+def __mark_relevant_boxes(terms, synonym_matcher, box_data, surrounding_box=None):
     boxes = box_data['boxes']
     dimensions = box_data['dimensions']
-    if surrounding_box is not None:
-        flat_relative_boxes = bounding_boxes \
-            .flatten_snippet_bounding_boxes(boxes, surrounding_box)
-    else:
-        flat_relative_boxes = bounding_boxes \
-            .flatten_bounding_boxes(boxes, dimensions['origWidth'], dimensions['origHeight'])
-    synonym_positions = __find_relevant_synonym_positions([box['word'] for box in flat_relative_boxes],
-                                                          synonyms, box_data['stems'])
+    with metrics.stage('flatten_boxes'):
+        if surrounding_box is not None:
+            flat_relative_boxes = bounding_boxes \
+                .flatten_snippet_bounding_boxes(boxes, surrounding_box, box_data.get('order'))
+        else:
+            flat_relative_boxes = bounding_boxes \
+                .flatten_bounding_boxes(boxes, dimensions['origWidth'], dimensions['origHeight'],
+                                        box_data.get('order'))
+    synonym_positions = synonym_matcher.locate([box['word'] for box in flat_relative_boxes], box_data['stems'])
     for i, box in enumerate(flat_relative_boxes):
         box['relevant'] = box['word'] in terms or i in synonym_positions
 
@@ -313,88 +424,34 @@ def __extend_multipart_stems(stems: dict):
     return extended_stems
 
 
-def __get_relevant_synonym_terms(doc, page, synonyms):
+def __get_relevant_synonym_terms(doc, page, synonym_matcher):
     metadata = __load_meta(doc, page)
-    return __find_relevant_synonym_terms(metadata['boxes'], metadata['stems'], synonyms)
+    return __find_relevant_synonym_terms(metadata['boxes'], metadata['stems'], synonym_matcher, metadata.get('order'))
 
 
-def __find_relevant_synonym_terms(boxes, page_stems, synonyms):
+def __find_relevant_synonym_terms(boxes, page_stems, synonym_matcher, order=None):
     """
     Sorts words contained in provided box data and finds full synonym matches in sorted text and stem mappings
 
     :param boxes: dict of bounding boxes with text data
     :param page_stems: stemmed terms of boxed words
-    :param synonyms: dict of synonyms (mainTerm => [terms])
+    :param synonym_matcher: synonym_util.SynonymMatcher of the query synonyms
+    :param order: precomputed reading order of the boxes
     :return: list of relevant synonym terms
     """
-    page_words = [box['word'] for box in bounding_boxes.flatten_bounding_boxes(boxes)]
-    synonyms = [item['terms'] + [item['mainTerm']] for item in synonyms if item['mainTerm'] != '']
-    processed_synonyms = []
+    with metrics.stage('flatten_boxes'):
+        page_words = [box['word'] for box in bounding_boxes.flatten_bounding_boxes(boxes, order=order)]
     relevant_synonyms = []
-
-    for synonym_list in synonyms:
-        for synonym in synonym_list:
-            # we ignore flavour text contained in parentheses
-            synonym = synonym_util.remove_parenthesis(synonym)
-
-            for term in synonym.split('/'):
-                # split synonyms containing slashes into separate terms
-                processed_synonyms.append(term)
-            # check for occasional stem synonym overlap and match
-            if synonym in page_stems:
-                relevant_synonyms.extend(page_stems[synonym])
-
-    for synonym in processed_synonyms:
-        if synonym_util.contains_synonym(synonym, page_words):
-            relevant_synonyms.append(synonym)
-    return relevant_synonyms
-
-
-def __find_relevant_synonym_positions(words, synonyms, stems):
-    """
-        Sorts words contained in provided box data and finds index positions of full synonym matches in sorted text
-
-        :param words: list of words
-        :param synonyms: dict of synonyms (mainTerm => [terms])
-        :param stems: dict of stems mapping to words
-        :return: list of indices containing relevant synonym words
-    """
-    synonyms = [item['terms'] + [item['mainTerm']] for item in synonyms if item['mainTerm'] != '']
-    processed_synonyms = synonym_util.process_synonyms(synonyms)
-    position_map = {}
-
-    for synonym in processed_synonyms:
-        for position in synonym_util.locate_synonym(synonym, words):
-            __add_or_create_dict_list(position_map, position, synonym)
-        try:
-            # try to find synonym in stems
-            inverse_stems = __combine_inverse_synonym_stems(stems, synonym)
-            for stem_combo in inverse_stems:
-                for position in synonym_util.locate_synonym(' '.join(stem_combo), words):
-                    __add_or_create_dict_list(position_map, position, synonym)
-        except (KeyError, ValueError):
-            pass
-    return position_map
-
-
-def __add_or_create_dict_list(dictionary, key, item):
-    try:
-        if item not in dictionary[key]:
-            dictionary[key].append(item)
-    except KeyError:
-        dictionary[key] = [item]
-
-
-def __combine_inverse_synonym_stems(stems, synonym):
-    stems_synonym = [stems[part] for part in synonym.split(' ')]
-    return list(itertools.product(*stems_synonym))
+    for synonym in synonym_matcher.terms:
+        # check for occasional stem synonym overlap and match
+        if synonym in page_stems:
+            relevant_synonyms.extend(page_stems[synonym])
+    return relevant_synonyms + synonym_matcher.matched_synonyms(page_words)
 
 
 def __load_meta(doc, page):
-    doc_dir = f'{config.metadata_path}/{doc}'
-    with open(f'{doc_dir}/{page}.json', 'r') as file:
-        metadata = json.load(file)
-        return metadata
+    with metrics.stage('metadata_load'):
+        return page_metadata.load(doc, page)
 
 
 def feed(id: str, parent_doc: str, page: str, collection: str, content: str):
@@ -410,80 +467,222 @@ def feed(id: str, parent_doc: str, page: str, collection: str, content: str):
     if not health_check():
         raise UnhealthyException()
 
+    result = feed_document(str(id), document_fields(parent_doc, page, collection, content))
+    query_cache.invalidate()
+    return result
+
+
+class BulkFeeder:
+    """
+    Feeds document pages into the vespa search engine with a bounded number of concurrent operations over keep-alive
+    connections. Operations rejected with 429 or 503 are retried with exponential backoff.
+
+    Usage:
+        with BulkFeeder() as feeder:
+            future = feeder.feed(id, parent_doc, page, collection, content)
+            result = future.result()  # vespa response JSON or raises FeedException/UnhealthyException
+    """
+
+    def __init__(self, connections=None):
+        """
+        :param connections: maximum number of feed operations in flight (default config.feed_connections)
+        """
+        self.connections = connections or config.feed_connections
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(self.connections)
+        self.changed = False
+
+    def __enter__(self):
+        if not health_check():
+            raise UnhealthyException()
+        self.executor = ThreadPoolExecutor(max_workers=self.connections)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.executor.shutdown(wait=True)
+        # invalidate cached query results once per bulk operation
+        if self.changed:
+            query_cache.invalidate()
+
+    def feed(self, id: str, parent_doc: str, page: str, collection: str, content: str):
+        """
+        Queue a document page for feeding, blocks while the maximum number of operations is in flight
+
+        :return: Future resolving to the vespa response JSON of the fed page
+        """
+        fields = document_fields(parent_doc, page, collection, content)
+        self.slots.acquire()
+        future = self.executor.submit(feed_document, str(id), fields)
+        future.add_done_callback(self.__done)
+        return future
+
+    def __done(self, future):
+        if future.exception() is None:
+            self.changed = True
+        self.slots.release()
+
+
+def document_fields(parent_doc, page, collection, content):
+    """
+    Build the vespa document fields of a document page, including the detected language of its content
+    """
     try:
         language = languagecodes.iso_639_alpha3(detect(content))
         if language is None:
             language = ''
     except LangDetectException:
         language = ''
-    response = app.feed_data_point(
-        schema="baseline",
-        data_id=str(id),
-        fields={
-            "language": language,
-            "parent_doc": parent_doc,
-            "page": page,
-            "collection": collection,
-            "body": content
-        }
-    )
+    return {
+        "language": language,
+        "parent_doc": parent_doc,
+        "page": page,
+        "collection": collection,
+        "body": content
+    }
+
 
+def feed_document(id, fields):
+    """
+    Feed a single document through the pooled feed session, retrying operations rejected with 429 or 503. Cached query
+    results are not invalidated, which is left to the bulk operation (see BulkFeeder).
+
+    :param id: desired id
+    :param fields: vespa document fields (see document_fields)
+    :return: vespa response JSON
+    """
+    with metrics.stage('feed'):
+        response = __document_operation('post', id, {'fields': fields})
     if response.status_code >= 400:
-        print(response.status_code, response.json, end="\n")
+        print(response.status_code, response.text, end="\n")
         raise FeedException(response)
-    return response.json
+    return response.json()
 
 
-def delete_document_pages(document):
-    try:
-        document_page_ids = fetch_document_ids(document)
-        if not document_page_ids:
-            # empty
-            return []
+def delete_page(id):
+    """
+    Remove a single document page from the vespa search engine
+
+    :param id: id of the page document
+    :return: vespa response JSON
+    """
+    response = __document_operation('delete', id)
+    if response.status_code >= 400 and response.status_code != 404:
+        print(response.status_code, response.text, end="\n")
+        raise FeedException(response)
+    if response.status_code < 300:
+        query_cache.invalidate()
+    return response.json()
+
+
+def __document_operation(method, id, body=None):
+    # document/v1 operation through the pooled vespa session, retrying operations rejected with 429 or 503
+    document_path = f'/document/v1/{schema}/{schema}/docid/{id}'
+    for attempt in range(config.feed_max_retries + 1):
+        last_attempt = attempt == config.feed_max_retries
         try:
-            result = app.delete_batch(batch=document_page_ids, schema=schema)
-            return result
-        except ValueError:
-            # also most likely empty
-            return []
-    except requests.ConnectionError as e:
-        raise UnhealthyException(e)
-    except requests.exceptions.RetryError as e:
-        raise TimeoutException(e)
+            response = vespa_http.request(method, document_path, timeout=config.feed_timeout, json=body)
+        except vespa_http.CircuitOpenException:
+            raise
+        except (TimeoutException, UnhealthyException) as e:
+            if last_attempt:
+                raise UnhealthyException(e)
+        else:
+            if response.status_code not in retry_status_codes or last_attempt:
+                return response
+        time.sleep(config.feed_backoff * 2 ** attempt)
 
 
-def fetch_document_ids(document):
-    yql = f'select * from sources * where parent_doc matches \"^{document}$\";'
-    hits = []
-    fetch_document_ids.offset_index = 0
+def delete_document_pages(document):
+    """
+    Remove all pages of a document from the vespa search engine. Page ids are streamed from a visit and deleted
+    concurrently while visiting continues.
 
-    def get_result_hits():
-        result = app.query(body={
-            "traceLevel": traceLevel,
-            "timeout": timeout,
-            "yql": yql,
-            "offset": fetch_document_ids.offset_index * max_hits,
-            "hits": max_hits
-        })
-        fetch_document_ids.offset_index += 1
-        return [{'id': hit['id'].split('::')[-1]} for hit in result.hits]
+    :return: list of vespa responses of the delete operations
+    """
+    def delete(id):
+        response = __document_operation('delete', id)
+        if response.status_code >= 500:
+            raise UnhealthyException(response.text)
+        if response.status_code >= 400 and response.status_code != 404:
+            print(response.status_code, response.text, end="\n")
+            raise FeedException(response)
+        return VespaResponse(json=__response_json(response), status_code=response.status_code, url=response.url,
+                             operation_type='delete')
+
+    with ThreadPoolExecutor(max_workers=config.feed_connections) as executor:
+        responses = list(executor.map(delete, visit_document_ids(document)))
+    if any(response.status_code < 300 for response in responses):
+        query_cache.invalidate()
+    return responses
+
+
+def visit_document_ids(document):
+    """
+    Stream the ids of all pages of a document
+
+    :return: generator of page document ids
+    """
+    for document_id in visit_documents(f'{schema}.parent_doc=={__selection_string(document)}', '[id]'):
+        yield document_id['id'].split('::')[-1]
 
-    while new_hits := get_result_hits():
-        hits.extend(new_hits)
-        if len(new_hits) < max_hits:
-            break
 
-    return hits
+def fetch_collection_documents(collection):
+    """
+    :return: sorted names of all documents with pages in a collection
+    """
+    documents = visit_documents(f'{schema}.collection=={__selection_string(collection)}', f'{schema}:parent_doc')
+    return sorted(set(document['fields']['parent_doc'] for document in documents))
+
+
+def visit_documents(selection, field_set):
+    """
+    Stream all documents matching a document selection by visiting the content nodes, which continues where the
+    previous batch ended instead of paging through search results
+
+    :param selection: vespa document selection (e.g. baseline.parent_doc=="name")
+    :param field_set: fields of the returned documents (e.g. [id] or baseline:parent_doc)
+    :return: generator of document dicts (id and fields)
+    """
+    params = {
+        'selection': selection,
+        'fieldSet': field_set,
+        'wantedDocumentCount': config.visit_documents,
+    }
+    while True:
+        response = vespa_http.request('get', f'/document/v1/{schema}/{schema}/docid', timeout=config.feed_timeout,
+                                      params=params)
+        if response.status_code == 504:
+            raise TimeoutException(response.text)
+        if response.status_code >= 500:
+            raise UnhealthyException(response.text)
+        if response.status_code >= 400:
+            print(response.status_code, response.text, end="\n")
+            raise FeedException(response)
+        result = __response_json(response)
+        yield from result.get('documents', [])
+        if 'continuation' not in result:
+            return
+        params['continuation'] = result['continuation']
+
+
+def __response_json(response):
+    # error responses of proxies in front of vespa are not necessarily JSON
+    try:
+        return response.json()
+    except ValueError:
+        raise UnhealthyException(f'{response.status_code} {response.text[:200]}')
+
+
+def __selection_string(value):
+    escaped_value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped_value}"'
 
 
 def health_check():
     """
     Checks if vespa search engine application is up and running
     """
-    try:
-        return requests.get(f'{url}:{port}/ApplicationStatus').status_code == 200
-    except Exception:
-        return False
+    return vespa_http.healthy()
 
 
 if __name__ == '__main__':
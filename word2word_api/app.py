@@ -3,6 +3,7 @@ from flask import Flask, request, abort
 app = Flask(__name__)
 import translate as translate_util
 import synonyms as synonyms_util
+import response_cache
 
 
 @app.route('/')
@@ -12,50 +13,101 @@ def hello_world():
 
 @app.route('/multilang-translate', methods=['POST'])
 def multi_translate():
-    if request.is_json:
-        body = request.json
-        try:
-            translations = translate_util.multilang_text_translate(
-                body['sourceLanguage'],
-                body['content']
-            )
-
-            if body['sourceLanguage'] == 'en':
-                terms = body['content']
-            else:
-                terms = translate_util.get_translated_terms(translations, 'en')
-
-            return {
-                "sourceLanguage": body['sourceLanguage'],
-                "languages": translate_util.get_supported_languages(),
-                "translations": translations,
-                "synonyms": synonyms_util.find_synonyms(terms)
-            }
-        except KeyError:
-            pass
-    # bad request if content type not JSON or missing/wrong JSON fields
-    abort(400)
+    query = __parse_query(request.get_json(silent=True), 'sourceLanguage')
+    if query is None:
+        # bad request if content type not JSON or missing/wrong JSON fields
+        abort(400)
+    return __cached_multilang_translate(*query)
+
+
+@app.route('/multilang-translate/batch', methods=['POST'])
+def multi_translate_batch():
+    """
+    Translate several queries at once, the JSON body holds a list of /multilang-translate request bodies:
+    {"queries": [{"sourceLanguage": "de", "content": ["Baum"]}, ...]}
+    """
+    body = request.get_json(silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if isinstance(queries, list):
+        queries = [__parse_query(query, 'sourceLanguage') for query in queries]
+    if not isinstance(queries, list) or None in queries:
+        # bad request if content type not JSON or missing/wrong JSON fields
+        abort(400)
+    return {
+        'results': [__cached_multilang_translate(*query) for query in queries]
+    }
+
+
+def __parse_query(body, *language_fields):
+    """
+    Validate a translation request body
+
+    :param body: parsed JSON body
+    :param language_fields: names of the language fields
+    :return: values of the language fields followed by the content, None if the body is not an object with string
+    languages and a list of strings as content
+    """
+    if not isinstance(body, dict):
+        return None
+    languages = [body.get(field) for field in language_fields]
+    content = body.get('content')
+    if not all(isinstance(language, str) for language in languages) or not isinstance(content, list) \
+            or not all(isinstance(word, str) for word in content):
+        return None
+    return *languages, content
+
+
+def __cached_multilang_translate(source, content):
+    return response_cache.cache.get(('multilang-translate', source, tuple(content)),
+                                    lambda: __multilang_translate(source, content))
+
+
+def __multilang_translate(source, content):
+    translations = translate_util.multilang_text_translate(source, content)
+
+    if source == 'en':
+        terms = content
+    else:
+        terms = translate_util.get_translated_terms(translations, 'en')
+
+    return {
+        "sourceLanguage": source,
+        "languages": translate_util.get_supported_languages(),
+        "translations": translations,
+        "synonyms": synonyms_util.find_synonyms(terms)
+    }
 
 
 @app.route('/translate', methods=['POST'])
 def translate():
-    if request.is_json:
-        body = request.json
-        try:
-            return {
-                'translation': translate_util.text_translate(
-                    body['sourceLanguage'],
-                    body['targetLanguage'],
-                    body['content'])
-            }
-        except KeyError:
-            pass
-    # bad request if content type not JSON or missing/wrong JSON fields
-    abort(400)
+    query = __parse_query(request.get_json(silent=True), 'sourceLanguage', 'targetLanguage')
+    if query is None:
+        # bad request if content type not JSON or missing/wrong JSON fields
+        abort(400)
+    source, target, content = query
+    return response_cache.cache.get(('translate', source, target, tuple(content)), lambda: {
+        'translation': translate_util.text_translate(source, target, content)
+    })
 
 
 @app.route('/supported-languages')
 def supported_languages():
     return {
-        'languages': translate_util.supported_languages
+        'languages': translate_util.supported_languages,
+        'loaded': translate_util.get_loaded_pairs()
+    }
+
+
+@app.route('/ready')
+def ready():
+    # healthy only once dictionaries have been loaded (see wsgi.py)
+    if not translate_util.ready:
+        abort(503)
+    return 'Ready'
+
+
+@app.route('/stats')
+def stats():
+    return {
+        'response_cache': response_cache.cache.stats()
     }
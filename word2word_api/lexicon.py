@@ -0,0 +1,192 @@
+"""
+Precompiled translation lexicon holding the best translation of every word of the word2word dictionaries from and to
+English, built offline by running this module.
+
+Layout (little-endian):
+    header          magic 'W2WL', format version (u16), pair count (u16)
+    pair table      per language pair: source (8 bytes), target (8 bytes), offset (u64), length (u64)
+    pairs           per pair: word count (u32), word data size (u32), translation data size (u32),
+                    count + 1 word offsets (u32), count + 1 translation offsets (u32), word data, translation data
+
+Words are sorted by their UTF-8 bytes, so that translations are looked up by binary search directly on the
+memory-mapped file. Worker processes thereby share the pages of a single file instead of unpickling dictionaries.
+"""
+
+import argparse
+import mmap
+import os
+import struct
+
+magic = b'W2WL'
+version = 1
+header_format = '<4sHH'
+pair_format = '<8s8sQQ'
+table_format = '<III'
+
+
+class Lexicon:
+    """
+    Read-only view of a memory-mapped lexicon file
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, file_version, pair_count = struct.unpack_from(header_format, self.buffer, 0)
+        if file_magic != magic or file_version > version:
+            raise ValueError(f'Unsupported lexicon file: {path}')
+
+        self.pairs = {}
+        table_offset = struct.calcsize(header_format)
+        for i in range(pair_count):
+            source, target, offset, length = struct.unpack_from(pair_format, self.buffer,
+                                                                table_offset + i * struct.calcsize(pair_format))
+            pair = (source.rstrip(b'\0').decode('ascii'), target.rstrip(b'\0').decode('ascii'))
+            self.pairs[pair] = TranslationTable(self.buffer, offset)
+
+    def get(self, source, target):
+        """
+        :return: TranslationTable of the language pair or None
+        """
+        return self.pairs.get((source, target))
+
+    def lookup(self, source, target, words):
+        """
+        Translate a list of words in one call
+
+        :return: list of best translations, None for words without translation. Raises KeyError if the language pair
+        is not part of the lexicon.
+        """
+        return self.pairs[(source, target)].lookup(words)
+
+    def read_ahead(self):
+        """
+        Ask the OS to load the whole file into the page cache, which is shared by all processes mapping it
+        """
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self.buffer.madvise(mmap.MADV_WILLNEED)
+
+    def close(self):
+        self.buffer.close()
+
+
+class TranslationTable:
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.count, word_size, translation_size = struct.unpack_from(table_format, buffer, offset)
+        self.word_offsets = offset + struct.calcsize(table_format)
+        self.translation_offsets = self.word_offsets + (self.count + 1) * 4
+        self.words = self.translation_offsets + (self.count + 1) * 4
+        self.translations = self.words + word_size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, word):
+        translation = self.find(word)
+        if translation is None:
+            raise KeyError(word)
+        return translation
+
+    def find(self, word):
+        """
+        Binary search for the best translation of a word, returns None if there is none
+        """
+        key = word.encode('utf-8')
+        low, high = 0, self.count - 1
+        while low <= high:
+            middle = (low + high) // 2
+            start, end = struct.unpack_from('<II', self.buffer, self.word_offsets + middle * 4)
+            value = self.buffer[self.words + start:self.words + end]
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle - 1
+            else:
+                start, end = struct.unpack_from('<II', self.buffer, self.translation_offsets + middle * 4)
+                return self.buffer[self.translations + start:self.translations + end].decode('utf-8')
+        return None
+
+    def lookup(self, words):
+        return [self.find(word) for word in words]
+
+
+def write(path, pairs):
+    """
+    Write a lexicon file
+
+    :param path: output path, replaced atomically so that running processes keep their mapping of the old file
+    :param pairs: dict of (source, target) language pairs to dicts of words and their best translation
+    """
+    sections = []
+    for (source, target), translations in pairs.items():
+        entries = sorted((word.encode('utf-8'), translation.encode('utf-8'))
+                         for word, translation in translations.items())
+        word_offsets, word_data = __pack_offsets([word for word, translation in entries])
+        translation_offsets, translation_data = __pack_offsets([translation for word, translation in entries])
+        sections.append(((source, target),
+                         struct.pack(table_format, len(entries), len(word_data), len(translation_data)) +
+                         word_offsets + translation_offsets + word_data + translation_data))
+
+    offset = struct.calcsize(header_format) + len(sections) * struct.calcsize(pair_format)
+    table = [struct.pack(header_format, magic, version, len(sections))]
+    for (source, target), data in sections:
+        table.append(struct.pack(pair_format, source.encode('ascii'), target.encode('ascii'), offset, len(data)))
+        offset += len(data)
+
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(b''.join(table))
+        for pair, data in sections:
+            file.write(data)
+    os.replace(temp_path, path)
+
+
+def __pack_offsets(values):
+    offsets = [0]
+    for value in values:
+        offsets.append(offsets[-1] + len(value))
+    return struct.pack(f'<{len(offsets)}I', *offsets), b''.join(values)
+
+
+def build(path, languages):
+    """
+    Compile the word2word dictionaries of all languages from and to English into a lexicon file
+
+    :param path: output path
+    :param languages: languages besides English
+    :return: number of words per language pair
+    """
+    from word2word import Word2word
+    import translate
+
+    pairs = {}
+    for language in languages:
+        for source, target in [(language, 'en'), ('en', language)]:
+            dictionary = Word2word(source, target)
+            translations = {}
+            for word in dictionary.word2x:
+                try:
+                    translations[word] = translate.get_first_valid_translation(dictionary(word), word)
+                except KeyError:
+                    # word without any translation
+                    pass
+            pairs[(source, target)] = translations
+    write(path, pairs)
+    return {f'{source}-{target}': len(translations) for (source, target), translations in pairs.items()}
+
+
+def main():
+    import translate
+
+    parser = argparse.ArgumentParser(description='Compile the word2word dictionaries into a translation lexicon')
+    parser.add_argument('path', type=str, nargs='?', default=translate.lexicon_path, help='the lexicon file to write')
+    parser.add_argument('-l', '--languages', type=str, nargs='+', default=translate.supported_languages,
+                        help='languages translated from and to english')
+    args = parser.parse_args()
+    for pair, count in build(args.path, args.languages).items():
+        print(f'Compiled {count} words of {pair}.')
+
+
+if __name__ == '__main__':
+    main()
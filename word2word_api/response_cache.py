@@ -0,0 +1,62 @@
+import configparser
+import threading
+import time
+from collections import OrderedDict
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+config = config['cache']
+
+
+class ResponseCache:
+    """
+    LRU cache of translation responses of a single worker process. Entries expire after ttl seconds, since the
+    dictionaries and synonyms only change with a restart the ttl merely bounds the lifetime of rarely used entries.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        Cached response for key, calling compute() on a miss
+
+        :param key: hashable key of the request
+        :param compute: function computing the response
+        """
+        if self.max_entries <= 0:
+            return compute()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        response = compute()
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return response
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests, 4) if requests else None,
+                'entries': len(self.entries),
+                'max_entries': self.max_entries
+            }
+
+
+cache = ResponseCache(config.getint('max-entries'), config.getint('ttl'))
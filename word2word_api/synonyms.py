@@ -1,11 +1,14 @@
 import csv
 import configparser
-import re
 
 config = configparser.ConfigParser()
 config.read('config.ini')
 config = config['synonyms']
 synonym_map = {}
+# character trie of all main terms, the TERM key of a node holds (position in synonym_map, main term) of the term
+# ending there
+synonym_trie = {}
+TERM = None
 
 
 def __remove_parenthesis(text: str):
@@ -25,16 +28,46 @@ def __add_term(main_term, row):
 
 
 def find_synonyms(term_list: list):
+    """
+    Find all main terms of the synonym map occurring in the given terms at the start of a word
+
+    :param term_list: list of (english) query terms
+    :return: list of matching synonym entries in the order of the synonym map
+    """
     terms = " ".join(term_list)
-    result = []
+    matches = set()
+
+    for start in range(len(terms)):
+        # same as a regex word boundary (\b) in front of the main term
+        if (start > 0 and __is_word_character(terms[start - 1])) == __is_word_character(terms[start]):
+            continue
+        node = synonym_trie
+        for position in range(start, len(terms)):
+            if TERM in node:
+                matches.add(node[TERM])
+            node = node.get(terms[position])
+            if node is None:
+                break
+        else:
+            if TERM in node:
+                matches.add(node[TERM])
+
+    return [{
+        'mainTerm': main_term,
+        'terms': synonym_map[main_term]
+    } for index, main_term in sorted(matches)]
+
 
-    for main_term, synonyms in synonym_map.items():
-        if re.search(r'\b'+main_term, terms) is not None:
-            result.append({
-                'mainTerm': main_term,
-                'terms': synonyms
-            })
-    return result
+def __is_word_character(character):
+    return character.isalnum() or character == '_'
+
+
+def __index_terms():
+    for index, main_term in enumerate(synonym_map):
+        node = synonym_trie
+        for character in main_term:
+            node = node.setdefault(character, {})
+        node[TERM] = (index, main_term)
 
 
 if config.getboolean('enabled'):
@@ -50,3 +83,5 @@ if config.getboolean('enabled'):
 
             for term in main_term.split('/'):
                 __add_term(term, row)
+
+    __index_terms()
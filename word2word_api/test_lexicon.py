@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+import lexicon
+import translate
+
+
+class FakeWord2word:
+    translations = {
+        ('de', 'en'): {'baum': ['1tree', 'tree', 'wood'], 'haus': ['house'], 'über': ['über-', 'above'], 'zahl': ['42']},
+        ('en', 'de'): {'tree': ['Baum'], 'house': ['Haus', 'Gebäude'], 'above': ['darüber'], 'a': ['ein']},
+        ('fr', 'en'): {'arbre': ['tree'], 'maison': ['house']}
+    }
+
+    def __init__(self, source, target):
+        self.pair = (source, target)
+        # vocabulary including a word without translations
+        self.word2x = {word: i for i, word in enumerate(list(self.translations[self.pair]) + ['leer'])}
+
+    def __call__(self, word, n_best=5):
+        return self.translations[self.pair][word][:n_best]
+
+
+class LexiconTest(unittest.TestCase):
+    words = {
+        ('de', 'en'): ['baum', 'haus', 'über', 'zahl', 'leer', 'unbekannt', ''],
+        ('en', 'de'): ['tree', 'house', 'above', 'a', 'unknown'],
+        ('fr', 'en'): ['arbre', 'maison', 'inconnu']
+    }
+
+    def setUp(self):
+        for patcher in [mock.patch('word2word.Word2word', FakeWord2word),
+                        mock.patch.multiple(translate, Word2word=FakeWord2word, dictionaries=OrderedDict(),
+                                            lexicon=None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'lexicon.bin')
+
+    def test_lookup_matches_dictionaries(self):
+        expected = {pair: translate.lookup(*pair, words) for pair, words in self.words.items()}
+        self.assertEqual(lexicon.build(self.path, ['de']), {'de-en': 4, 'en-de': 4})
+
+        translate.lexicon = lexicon.Lexicon(self.path)
+        self.addCleanup(translate.lexicon.close)
+        for pair, words in self.words.items():
+            self.assertEqual(translate.lookup(*pair, words), expected[pair], pair)
+        self.assertEqual(translate.lexicon.lookup('de', 'en', self.words[('de', 'en')]),
+                         expected[('de', 'en')])
+        self.assertEqual(expected[('de', 'en')], ['tree', 'house', 'above', 'zahl', None, None, None])
+
+    def test_missing_pairs(self):
+        lexicon.build(self.path, ['de'])
+        translate.lexicon = lexicon.Lexicon(self.path)
+        self.addCleanup(translate.lexicon.close)
+        self.assertIsNone(translate.lexicon.get('fr', 'en'))
+        self.assertRaises(KeyError, translate.lexicon.lookup, 'fr', 'en', ['arbre'])
+        self.assertRaises(KeyError, translate.lookup, 'de', 'fr', ['baum'])
+
+    def test_unsupported_file(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'W2WD' + bytes(4))
+        self.assertRaises(ValueError, lexicon.Lexicon, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
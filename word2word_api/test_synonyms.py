@@ -0,0 +1,56 @@
+import re
+import unittest
+from unittest import mock
+
+import synonyms
+
+synonym_map = {
+    'car': ['automobile', 'Auto'],
+    'new york': ['NYC', 'New York City'],
+    'new': ['novel'],
+    '.net': ['dotnet'],
+    'über': ['uber'],
+    'york': ['Eboracum']
+}
+
+
+class FindSynonymsTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple(synonyms, synonym_map=dict(synonym_map), synonym_trie={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        getattr(synonyms, '__index_terms')()
+
+    def test_main_terms_match_at_the_start_of_words(self):
+        self.assertEqual(self.main_terms(['cars']), ['car'])
+        self.assertEqual(self.main_terms(['scar']), [])
+        self.assertEqual(self.main_terms(['a', 'red_car']), [])
+        self.assertEqual(self.main_terms(['über-car']), ['car', 'über'])
+
+    def test_terms_are_matched_across_words_in_order_of_the_synonym_map(self):
+        self.assertEqual(self.main_terms(['york', 'new', 'york']), ['new york', 'new', 'york'])
+        self.assertEqual(self.main_terms(['newyork']), ['new'])
+        self.assertEqual(synonyms.find_synonyms(['new', 'york'])[0], {
+            'mainTerm': 'new york',
+            'terms': ['NYC', 'New York City']
+        })
+
+    def test_main_terms_starting_with_non_word_characters(self):
+        self.assertEqual(self.main_terms(['asp.net']), ['.net'])
+        self.assertEqual(self.main_terms(['.net']), [])
+        self.assertEqual(self.main_terms(['the', '.net']), [])
+
+    def test_same_matches_as_regex_word_boundary(self):
+        queries = [['cars'], ['scar', 'new'], ['asp.net', 'york'], ['über'], ['_car'], ['new', 'york', 'car'], ['']]
+        for query in queries:
+            terms = ' '.join(query)
+            expected = [term for term in synonym_map if re.search(r'\b' + re.escape(term), terms) is not None]
+            self.assertEqual(self.main_terms(query), expected, query)
+
+    @staticmethod
+    def main_terms(term_list):
+        return [synonym['mainTerm'] for synonym in synonyms.find_synonyms(term_list)]
+
+
+if __name__ == '__main__':
+    unittest.main()
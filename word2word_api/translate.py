@@ -1,52 +1,29 @@
+import configparser
+import os
+import threading
 import unicodedata
+from collections import OrderedDict
 
 from word2word import Word2word
 
-de2en = Word2word('de', 'en')
-fr2en = Word2word('fr', 'en')
-ca2en = Word2word('ca', 'en')
-it2en = Word2word('it', 'en')
-es2en = Word2word('es', 'en')
-ru2en = Word2word('ru', 'en')
-pl2en = Word2word('pl', 'en')
-bn2en = Word2word('bn', 'en')
-da2en = Word2word('da', 'en')
-
-en2de = Word2word('en', 'de')
-en2fr = Word2word('en', 'fr')
-en2ca = Word2word('en', 'ca')
-en2it = Word2word('en', 'it')
-en2es = Word2word('en', 'es')
-en2ru = Word2word('en', 'ru')
-en2pl = Word2word('en', 'pl')
-en2bn = Word2word('en', 'bn')
-en2da = Word2word('en', 'da')
-
-source_map = {
-    'de': de2en,
-    'fr': fr2en,
-    'ca': ca2en,
-    'it': it2en,
-    'es': es2en,
-    'ru': ru2en,
-    'pl': pl2en,
-    'bn': bn2en,
-    'da': da2en,
-}
-
-target_map = {
-    'de': en2de,
-    'fr': en2fr,
-    'ca': en2ca,
-    'it': en2it,
-    'es': en2es,
-    'ru': en2ru,
-    'pl': en2pl,
-    'bn': en2bn,
-    'da': en2da,
-}
-
-supported_languages = list(source_map.keys())
+import lexicon as lexicon_util
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+config = config['translation']
+
+supported_languages = [language.strip() for language in config['languages'].split(',') if language.strip()]
+max_dictionaries = config.getint('max-dictionaries')
+lexicon_path = config['lexicon']
+verbose = config.getboolean('verbose')
+
+# loaded word2word dictionaries by (source, target) language pair, least recently used first
+dictionaries = OrderedDict()
+dictionaries_lock = threading.Lock()
+loading_locks = {}
+# precompiled lexicon (see lexicon.py), language pairs missing in the lexicon are translated with word2word dictionaries
+lexicon = lexicon_util.Lexicon(lexicon_path) if os.path.isfile(lexicon_path) else None
+ready = False  # set by warm_up()
 
 stopwords = ["i", "me", "my", "myself", "we", "our", "ours", "ourselves",
                 "you", "your", "yours", "yourself", "yourselves", "he", "him", "his", "himself", "she", "her", "hers",
@@ -72,6 +49,65 @@ def get_supported_languages():
     return supported_languages + ['en']
 
 
+def is_supported_pair(source, target):
+    return source != target and 'en' in (source, target) and \
+        (target if source == 'en' else source) in supported_languages
+
+
+def get_dictionary(source, target):
+    """
+    Word2word dictionary of a language pair from or to English, which is loaded on first use. At most
+    max-dictionaries pairs are kept in memory, exceeding pairs are evicted in least recently used order.
+
+    :return: Word2word instance, raises KeyError if the language pair is not supported
+    """
+    pair = (source, target)
+    if not is_supported_pair(source, target):
+        raise KeyError(pair)
+    with dictionaries_lock:
+        if pair in dictionaries:
+            dictionaries.move_to_end(pair)
+            return dictionaries[pair]
+        loading_lock = loading_locks.setdefault(pair, threading.Lock())
+
+    # a pair is only loaded once even if requested concurrently, other pairs remain available meanwhile
+    with loading_lock:
+        with dictionaries_lock:
+            if pair in dictionaries:
+                dictionaries.move_to_end(pair)
+                return dictionaries[pair]
+        dictionary = Word2word(source, target)
+        with dictionaries_lock:
+            dictionaries[pair] = dictionary
+            while 0 < max_dictionaries < len(dictionaries):
+                dictionaries.popitem(last=False)
+        return dictionary
+
+
+def warm_up():
+    """
+    Load the lexicon and the preloaded language pairs before serving requests. Under gunicorn this runs once in the
+    master process, so that forked workers share the loaded data copy-on-write.
+    """
+    global ready
+    if lexicon is not None:
+        lexicon.read_ahead()
+    for pair in [pair.strip() for pair in config['preload'].split(',') if pair.strip()]:
+        get_dictionary(*pair.split('-'))
+    ready = True
+
+
+def get_loaded_pairs():
+    """
+    :return: currently loaded language pairs (e.g. 'de-en'), the pairs of the lexicon followed by the word2word
+    dictionaries, least recently used first
+    """
+    pairs = sorted(lexicon.pairs.keys()) if lexicon is not None else []
+    with dictionaries_lock:
+        pairs += [pair for pair in dictionaries.keys() if pair not in pairs]
+    return [f'{source}-{target}' for source, target in pairs]
+
+
 def multilang_text_translate(source, words: [str]):
     """
     Dictionary translate a list of words from source language to all other supported languages
@@ -83,18 +119,24 @@ def multilang_text_translate(source, words: [str]):
     translations = [
         {"languageCode": source, "content": words}
     ]
+    if source == 'en' or source == 'un':
+        translated_words = list(words)
+    else:
+        try:
+            translated_words = lookup(source, 'en', words)
+        except KeyError:
+            translated_words = [None] * len(words)
     english_words = []
     english_words_filtered = []
-    for word in words:
-        try:
-            translated_word = to_english(source, word)
-            english_words.append(translated_word)
-            if translated_word not in stopwords:
-                # filter out stopwords before translating into other languages
-                english_words_filtered.append(translated_word)
-        except TranslationException:
+    for translated_word in translated_words:
+        if translated_word is None:
             # do not further translate words, that have no english translation
             english_words_filtered.append('')
+            continue
+        english_words.append(translated_word)
+        if translated_word not in stopwords:
+            # filter out stopwords before translating into other languages
+            english_words_filtered.append(translated_word)
     if source == 'en':
         translations[0]['content'] = english_words_filtered
         translations[0]['contentOrig'] = english_words
@@ -103,14 +145,62 @@ def multilang_text_translate(source, words: [str]):
             {"languageCode": 'en', "content": english_words_filtered, "contentOrig": english_words}
         )
 
-    for language in [language for language in supported_languages if language != source]:
+    targets = [language for language in supported_languages if language != source]
+    for language, content in translate_from_english(english_words_filtered, targets).items():
         translations.append(
-            {"languageCode": language, "content": text_translate('en', language, english_words_filtered)}
+            {"languageCode": language, "content": content}
         )
 
     return translations
 
 
+def translate_from_english(words: [str], languages: [str]):
+    """
+    Dictionary translate a list of english words into several target languages at once
+
+    :param words: English words to be translated
+    :param languages: The target languages
+    :return: dict of target languages and their best translation options, or the original word if no translation was
+    found
+    """
+    translations = {}
+    for language in languages:
+        try:
+            translated_words = lookup('en', language, words)
+        except KeyError:
+            translated_words = [None] * len(words)
+        translations[language] = [word if translated_word is None else translated_word
+                                  for word, translated_word in zip(words, translated_words)]
+    return translations
+
+
+def lookup(source, target, words: [str]):
+    """
+    Look up the best translations of a list of words, in the precompiled lexicon if it contains the language pair or
+    in the word2word dictionary otherwise
+
+    :param source: The source language
+    :param target: The target language, either source or target language is English
+    :param words: Words to be translated
+    :return: list of best translation options, None for words without translation. Raises KeyError if the language
+    pair is not supported.
+    """
+    if not is_supported_pair(source, target):
+        raise KeyError((source, target))
+    table = lexicon.get(source, target) if lexicon is not None else None
+    if table is not None:
+        return table.lookup(words)
+
+    dictionary = get_dictionary(source, target)
+    translations = []
+    for word in words:
+        try:
+            translations.append(get_first_valid_translation(dictionary(word), word))
+        except KeyError:
+            translations.append(None)
+    return translations
+
+
 def text_translate(source, target, words: [str]):
     """
     Dictionary translate a list of words from source to target language
@@ -142,29 +232,30 @@ def word_translate(source, target, word):
 
 def to_english(source, word):
     if source == 'en' or source == 'un':
-        translations = [word]
+        translation = word
     else:
         try:
-            translations = source_map[source](word)
+            translation = lookup(source, 'en', [word])[0]
         except KeyError:
-            # Fired when source language is non-existent,
-            # or there is no translation for the word
+            # Fired when source language is non-existent
+            translation = None
+        if translation is None:
             raise TranslationException
 
-    print(f"Intermediate translation for '{word}' from {source} to en: {translations}")
-    translation = get_first_valid_translation(translations, word)
-    print(f'Picking best option {translation}')
+    if verbose:
+        print(f"Intermediate translation for '{word}' from {source} to en: {translation}")
     return translation
 
 
 def to_target(target, word):
     try:
-        translations = target_map[target](word)
+        translation = lookup('en', target, [word])[0]
     except KeyError:
-        translations = [word]
-    print(f"Translation for '{word}' from en to {target}: {translations}")
-    translation = get_first_valid_translation(translations, word)
-    print(f'Picking best option {translation}')
+        translation = None
+    if translation is None:
+        translation = word
+    if verbose:
+        print(f"Translation for '{word}' from en to {target}: {translation}")
     return translation
 
 
@@ -0,0 +1,12 @@
+import gc
+
+import translate
+from app import app
+
+# loaded before gunicorn forks its workers if preload_app is set
+translate.warm_up()
+# exclude loaded objects from garbage collection, which would otherwise copy their memory pages into every worker
+gc.freeze()
+
+if __name__ == "__main__":
+    app.run()